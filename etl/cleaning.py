@@ -1,28 +1,38 @@
-from utils import io, helpers
+from utils import io, helpers, parallel
 
 import calendar
 import itertools
 import os
 import pandas as pd
 
+# Rows per chunk read from the raw csv; peak memory scales with this rather than with the month
+CHUNKSIZE = 1_000_000
+# Rough in-memory bytes per raw row while parsing, cleaning and writing a chunk
+BYTES_PER_ROW = 500
+
+
+def clean_month(month: str, year: str) -> str:
+    raw_chunks = io.read_file(month, year, chunksize=CHUNKSIZE)
+
+    first, last = calendar.monthrange(int(year), int(month))
+    first_day = f'{year}-{month}-{first:02d}'
+    last_day = f'{year}-{month}-{last:02d}'
+    clean_chunks = (helpers.remove_zero_fare_and_oob_rows(
+        raw_df, first_day, last_day) for raw_df in raw_chunks)
+
+    # Write "clean" df to s3 chunk by chunk
+    component = os.path.join('clean', f'{year}_{month}')
+    return io.save_output_chunks(clean_chunks, component)
+
 
 def main():
     months = [f'{month:02d}' for month in range(1, 13)]
     years = ['2020']
     product = itertools.product(months, years)
 
-    for month, year in product:
-        raw_df = io.read_file(month, year)
-
-        first, last = calendar.monthrange(int(year), int(month))
-        first_day = f'{year}-{month}-{first:02d}'
-        last_day = f'{year}-{month}-{last:02d}'
-        clean_df = helpers.remove_zero_fare_and_oob_rows(
-            raw_df, first_day, last_day)
-
-        # Write "clean" df to s3
-        component = os.path.join('clean', f'{year}_{month}')
-        print(io.save_output_df(clean_df, component))
+    # Months are independent, so clean them in parallel
+    parallel.run_months(clean_month, product,
+                        estimate_memory=lambda month, year: CHUNKSIZE * BYTES_PER_ROW)
 
 
 if __name__ == '__main__':
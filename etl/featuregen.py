@@ -1,8 +1,45 @@
-from utils import io, feature_generators
+from utils import io, feature_generators, parallel
 
 import itertools
 import os
-import pandas as pd
+
+# Rough ratio of peak memory while generating features to the size of the clean parquet file
+PARQUET_EXPANSION = 10
+# Set FORCE_FEATUREGEN=1 to recompute months whose inputs and generators haven't changed
+FORCE = os.environ.get('FORCE_FEATUREGEN') == '1'
+
+
+def get_feature_plan() -> feature_generators.FeaturePlan:
+    # Create features and label in one frame, keeping the pickup time for splits
+    return feature_generators.FeaturePlan([feature_generators.Pickup(), feature_generators.Trip(), feature_generators.Categorical(),
+                                           feature_generators.HighTip()], passthrough_columns=['tpep_pickup_datetime'])
+
+
+def generate_features(month: str, year: str) -> str:
+    clean_component = os.path.join('clean', f'{year}_{month}')
+    features_component = os.path.join('features', f'{year}_{month}')
+    plan = get_feature_plan()
+
+    # Skip the month if the latest features were computed from the same clean data with the same code
+    clean_path = io.get_output_path(clean_component)
+    fingerprint = plan.fingerprint(clean_path)
+    if not FORCE and io.load_manifest(features_component).get('latest') and \
+            io.get_output_metadata(features_component).get('fingerprint') == fingerprint:
+        return f'{io.get_output_path(features_component)} (up to date)'
+
+    # Load the clean data that was fingerprinted
+    clean_version = os.path.basename(clean_path).split('.')[0]
+    df = io.load_output_df(clean_component, version=clean_version)
+    features_df = plan.compute(df)
+
+    # Write features to s3
+    return io.save_output_df(features_df, features_component, metadata={'fingerprint': fingerprint, 'input': clean_path},
+                             schema=plan.schema())
+
+
+def estimate_memory(month: str, year: str) -> int:
+    clean_component = os.path.join('clean', f'{year}_{month}')
+    return io.get_output_size(clean_component) * PARQUET_EXPANSION
 
 
 def main():
@@ -10,24 +47,9 @@ def main():
     years = ['2020']
     product = itertools.product(months, years)
 
-    for month, year in product:
-        # Load latest clean data
-        clean_component = os.path.join('clean', f'{year}_{month}')
-        df = io.load_output_df(clean_component)
-
-        # Create features and label
-        pickup_features = feature_generators.Pickup().compute(df)
-        trip_features = feature_generators.Trip().compute(df)
-        categorical_features = feature_generators.Categorical().compute(df)
-        label = feature_generators.HighTip().compute(df)
-
-        # Concatenate features
-        features_df = pd.concat(
-            [pickup_features, trip_features, categorical_features, label, df['tpep_pickup_datetime'].to_frame()], axis=1)
-
-        # Write features to s3
-        features_component = os.path.join('features', f'{year}_{month}')
-        print(io.save_output_df(features_df, features_component))
+    # Months are independent, so generate their features in parallel
+    parallel.run_months(generate_features, product,
+                        estimate_memory=estimate_memory)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,17 @@
+from utils import io
+
+import itertools
+
+
+def main():
+    months = [f'{month:02d}' for month in range(1, 13)]
+    years = ['2020']
+    product = itertools.product(months, years)
+
+    for month, year in product:
+        # Convert raw csv to parquet in the local cache, once per month
+        print(io.cache_raw_file(month, year))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,261 @@
-from flask import Flask, jsonify, request
-from utils import models
+"""
+app.py
 
-import pandas as pd
+Inference API for the high tip model. Run `python inference/app.py` for the Flask development server, or inference/server.py
+for production. The model is loaded by start(), after the server forks its workers, rather than on import.
+
+Records are either the model's features, or raw trips (with tpep_pickup_datetime), whose features are computed here by the
+same generators featuregen uses.
+
+/metrics exposes request counts, per stage latency histograms, batch sizes and the model version in the Prometheus text format.
+"""
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+from utils import feature_generators, io, models, serving, telemetry
+
+import json
+import os
+import time
+
+ARTIFACT_COMPONENT = 'training/artifacts'
+# Largest number of records accepted by /predict_batch in one request
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 100_000))
+# Largest request body in bytes, checked before the body is read. Raw trips are about 500 bytes of JSON each.
+MAX_BODY_BYTES = int(os.environ.get('MAX_BODY_BYTES', MAX_BATCH_SIZE * 1024))
+# Predictions serialized per chunk of a streamed response
+STREAM_CHUNKSIZE = 10_000
+JSONL_MIMETYPES = ['application/x-ndjson', 'application/jsonl',
+                   'application/x-jsonlines']
+# Endpoints whose requests are counted and timed
+PREDICT_ENDPOINTS = ['predict', 'predict_batch']
+STAGES = ['decode', 'preprocess', 'predict', 'serialize']
 
 app = Flask('high_tip_app')
-global mw
-mw = models.RandomForestModelWrapper.load('training/models')
+# Bigger bodies get a 413 from the Content-Length header, or once that many bytes of a chunked body are read
+app.config['MAX_CONTENT_LENGTH'] = MAX_BODY_BYTES
+# Computes features for raw trips
+online_plan = feature_generators.FeaturePlan(
+    [feature_generators.Pickup(), feature_generators.Trip(), feature_generators.Categorical()])
+
+
+def _load_model(version: str) -> models.RandomForestModelWrapper:
+    # The artifact's compiled forest is memory mapped, so loading is instant and workers share one copy of the trees
+    return models.RandomForestModelWrapper.load_artifact(ARTIFACT_COMPONENT, version=version)
+
+
+def _latest_version() -> str:
+    return os.path.basename(io.get_output_path(ARTIFACT_COMPONENT)).split('.')[0]
+
+
+def _warm_up(mw: models.RandomForestModelWrapper):
+    """Runs one prediction, so the first request doesn't pay for paging in the model and allocating buffers."""
+    mw.predict_records([{col: 0 for col in mw.feature_columns}])
+
+
+# Optional cache of recent predictions (see PREDICTION_CACHE_SIZE and PREDICTION_CACHE_TTL), cleared when a new version loads
+cache = serving.PredictionCache()
+# Serves the latest training/artifacts version, checking for new ones every MODEL_RELOAD_INTERVAL seconds
+reloader = serving.ModelReloader(_load_model, _latest_version, _warm_up,
+                                 on_load=lambda mw, version: cache.clear())
+
+# Created on import, before the production server forks, so every worker records into its own row of the same shared metrics
+requests_total = telemetry.Counter('high_tip_requests_total', 'Prediction requests by endpoint and status class.', ['endpoint', 'status'],
+                                   [(endpoint, status) for endpoint in PREDICT_ENDPOINTS for status in ['2xx', '4xx', '5xx']])
+request_seconds = telemetry.Histogram('high_tip_request_seconds', 'Prediction request latency, until the response is sent.',
+                                      'endpoint', PREDICT_ENDPOINTS, scale=1e-6)
+# decode, preprocess and serialize are timed per request. predict (building the feature matrix and scoring it) is timed per
+# model call, which is a micro-batch of requests for /predict.
+stage_seconds = telemetry.Histogram('high_tip_stage_seconds', 'Prediction latency by stage.',
+                                    'stage', STAGES, scale=1e-6)
+batch_size = telemetry.Histogram('high_tip_batch_size', 'Records scored per model call.',
+                                 'endpoint', PREDICT_ENDPOINTS)
+model_info = telemetry.Info('high_tip_model_info', 'Served model version.',
+                            lambda: {'version': reloader.current[1] or ''})
+
+
+def _predict_records(records: list, endpoint: str) -> list:
+    mw, version = reloader.current
+    with stage_seconds.time('predict'):
+        preds = cache.predict(mw.records_to_matrix(
+            records), version, mw.predict_matrix).tolist()
+    batch_size.record(len(records), endpoint)
+    return preds
+
+
+# Concurrent /predict requests are scored together (see PREDICT_MAX_BATCH_SIZE and PREDICT_MAX_WAIT_MS)
+batcher = serving.MicroBatcher(lambda records: _predict_records(records, 'predict'))
+
+
+def start():
+    """Loads and warms up the model, then starts checking for new versions. Called once per server process."""
+    reloader.start()
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness check: succeeds once a model has been loaded and has made a warm-up prediction."""
+    mw, version = reloader.current
+    if mw is None:
+        return jsonify({'ready': False}), 503
+    return jsonify({'ready': True, 'version': version})
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Prediction cache counters for this process (i.e. to tune PREDICTION_CACHE_SIZE), and latency percentiles in milliseconds."""
+    latency = {stage: {'p50': stage_seconds.percentile(50, stage) * 1000, 'p99': stage_seconds.percentile(99, stage) * 1000}
+               for stage in STAGES}
+    return jsonify({'cache': cache.stats(), 'latency_ms': latency})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics for the whole server, except the model version, which is this worker's."""
+    return Response(telemetry.render([requests_total, request_seconds, stage_seconds, batch_size, model_info]),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.errorhandler(413)
+def body_too_large(e):
+    return jsonify({'error': f'Request bodies can be at most {MAX_BODY_BYTES} bytes.'}), 413
+
+
+@app.before_request
+def _start_timer():
+    g.start = time.perf_counter_ns()
+
+
+@app.after_request
+def _count_request(response: Response) -> Response:
+    if request.endpoint not in PREDICT_ENDPOINTS:
+        return response
+    endpoint, start = request.endpoint, g.start
+    requests_total.inc(endpoint, f'{response.status_code // 100}xx')
+    # Streamed responses are only finished once the body has been sent
+    response.call_on_close(lambda: request_seconds.record(
+        (time.perf_counter_ns() - start) // 1000, endpoint))
+    return response
 
 
 @app.route('/predict', methods=['POST'])
 def predict():
-    req = request.get_json()
-    preds = mw.predict(pd.DataFrame({k: [v] for k, v in req.items()}))
+    mw, _ = reloader.current
+    if mw is None:
+        return jsonify({'error': 'Model is not loaded yet.'}), 503
+    with stage_seconds.time('decode'):
+        req = request.get_json()
+    try:
+        with stage_seconds.time('preprocess'):
+            records = _to_feature_records([req])
+            _validate_records(mw, records)
+        pred = batcher.predict(records[0])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     result = {
-        'prediction': preds[0]
+        'prediction': pred
     }
-    return jsonify(result)
+    with stage_seconds.time('serialize'):
+        return jsonify(result)
+
+
+@app.route('/predict_batch', methods=['POST'])
+def predict_batch():
+    """
+    Scores many trips in one request. The body is either a JSON array of feature objects or JSONL (one object per line, with
+    a JSONL content type). Predictions are streamed back in the same order and format: a JSON array or JSONL of {"prediction": p}.
+    """
+    mw, _ = reloader.current
+    if mw is None:
+        return jsonify({'error': 'Model is not loaded yet.'}), 503
+    jsonl = request.mimetype in JSONL_MIMETYPES
+    try:
+        records = _decode_records(request.get_data(), jsonl)
+        # Bodies within MAX_BODY_BYTES can still hold too many small records. Checked before any features are computed.
+        if len(records) > MAX_BATCH_SIZE:
+            return jsonify({'error': f'At most {MAX_BATCH_SIZE} records can be scored per request.'}), 413
+        with stage_seconds.time('preprocess'):
+            records = _to_feature_records(records)
+            _validate_records(mw, records)
+        # One vectorized call for the whole batch
+        preds = _predict_records(records, 'predict_batch')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return Response(stream_with_context(_serialize_predictions(preds, jsonl)),
+                    mimetype=JSONL_MIMETYPES[0] if jsonl else 'application/json')
+
+
+def _decode_records(body: bytes, jsonl: bool) -> list:
+    """Parses a request body into a list of records. Raises ValueError describing the first malformed line or body."""
+    with stage_seconds.time('decode'):
+        if jsonl:
+            records = []
+            for i, line in enumerate(body.splitlines()):
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    raise ValueError(f'Line {i + 1} is not valid JSON: {e}')
+        else:
+            try:
+                records = json.loads(body)
+            except json.JSONDecodeError as e:
+                raise ValueError(f'Body is not valid JSON: {e}')
+            if not isinstance(records, list):
+                raise ValueError('Body must be a JSON array of records.')
+    return records
+
+
+def _to_feature_records(records: list) -> list:
+    """Replaces raw trips with their features. Raises ValueError if a raw trip is missing a column or has a malformed value."""
+    feature_records = []
+    for i, record in enumerate(records):
+        if isinstance(record, dict) and 'tpep_pickup_datetime' in record:
+            missing = [
+                col for col in online_plan.required_columns if col not in record]
+            if missing:
+                raise ValueError(f'Record {i} is missing columns {missing}.')
+            try:
+                record = online_plan.compute_record(record)
+            except ValueError as e:
+                raise ValueError(f'Record {i}: {e}')
+        feature_records.append(record)
+    return feature_records
+
+
+def _validate_records(mw: models.ModelWrapper, records: list):
+    """Raises ValueError if a record isn't an object with every feature the model uses."""
+    for i, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise ValueError(f'Record {i} is not an object.')
+        missing = [col for col in mw.feature_columns if col not in record]
+        if missing:
+            raise ValueError(f'Record {i} is missing features {missing}.')
+
+
+def _serialize_predictions(preds: list, jsonl: bool):
+    """Yields the predictions as JSONL or as a JSON array, a chunk at a time. Only time spent formatting is timed, not sending."""
+    elapsed = 0
+    if not jsonl:
+        yield '['
+    for start in range(0, len(preds), STREAM_CHUNKSIZE):
+        chunk_start = time.perf_counter_ns()
+        lines = ['{"prediction": %r}' % pred for pred in preds[start:start + STREAM_CHUNKSIZE]]
+        if jsonl:
+            chunk = '\n'.join(lines) + '\n'
+        else:
+            chunk = (',' if start else '') + ','.join(lines)
+        elapsed += time.perf_counter_ns() - chunk_start
+        yield chunk
+    if not jsonl:
+        yield ']'
+    stage_seconds.record(elapsed // 1000, 'serialize')
 
 
 def main():
-    app.run(debug=True)
+    start()
+    # The reloader would import (and load) the app twice
+    app.run(debug=True, use_reloader=False)
 
 
 if __name__ == '__main__':
@@ -4,16 +4,18 @@ inference.py
 Sample script that runs inference on random examples in December 2020. It pings the "api" (served locally in inference/app.py) and gets a response. To use, make sure you are also running inference/app.py.
 """
 
-from utils import io
+from utils import io, feature_generators
 
 import pandas as pd
 import requests
 
 
 def main():
-    # Grab latest features and model wrapper
+    # Grab a sample of the latest features, reading only the model's input columns
+    feature_columns = [col for generator in [feature_generators.Pickup(), feature_generators.Trip(), feature_generators.Categorical()]
+                       for col in generator.schema()]
     df = io.load_output_df(
-        'features/2020_12').drop('tpep_pickup_datetime', axis=1)
+        'features/2020_12', columns=feature_columns, sample_frac=0.1)
 
     # Run model on latest features for a random example
     url = 'http://localhost:5000/predict'
@@ -0,0 +1,182 @@
+"""
+loadtest.py
+
+Load generator for the inference API (inference/app.py or inference/server.py). It replays records from a JSONL file (one
+request body per line, i.e. a log of /predict requests), or samples them from the latest features/<month>, against /predict
+or /predict_batch, then reports throughput, latency percentiles and the error rate.
+
+By default the test is closed loop: LOADTEST_CONCURRENCY clients each send a request as soon as their last one returns. With
+LOADTEST_RATE set, it is open loop: requests arrive as a Poisson process at that rate, whether or not earlier ones have
+returned, and their latency is measured from when they were due, so time spent waiting for a free client counts.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from utils import feature_generators, io, telemetry
+
+import collections
+import itertools
+import json
+import numpy as np
+import os
+import requests
+import threading
+import time
+import typing
+
+URL = os.environ.get('LOADTEST_URL', 'http://localhost:5000')
+# Either predict or predict_batch
+ENDPOINT = os.environ.get('LOADTEST_ENDPOINT', 'predict')
+# JSONL file of records to replay. If empty, records are sampled from features/LOADTEST_MONTH.
+INPUT_PATH = os.environ.get('LOADTEST_INPUT', '')
+MONTH = os.environ.get('LOADTEST_MONTH', '2020_12')
+SAMPLE_FRAC = float(os.environ.get('LOADTEST_SAMPLE_FRAC', 0.1))
+# Records per /predict_batch request
+BATCH_SIZE = int(os.environ.get('LOADTEST_BATCH_SIZE', 100))
+# Concurrent clients, which is also the most requests in flight in open loop tests
+CONCURRENCY = int(os.environ.get('LOADTEST_CONCURRENCY', 8))
+# Requests per second for an open loop test. 0 runs a closed loop test.
+RATE = float(os.environ.get('LOADTEST_RATE', 0))
+DURATION = float(os.environ.get('LOADTEST_DURATION', 30))
+# Seconds before a request counts as an error
+TIMEOUT = float(os.environ.get('LOADTEST_TIMEOUT', 10))
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+def load_records(path: str = INPUT_PATH, month: str = MONTH, sample_frac: float = SAMPLE_FRAC) -> typing.List[dict]:
+    """
+    This function loads the records to send, either from a JSONL file or from a sample of the model's input columns in the
+    latest features/<month>.
+
+    Args:
+        path (str, optional): JSONL file with one record per line. If empty, records are sampled from the features.
+        month (str, optional): month of features to sample, i.e. "2020_12"
+        sample_frac (float, optional): fraction of the month's row groups to sample
+
+    Returns:
+        records (List[dict]): records in file or sample order
+    """
+    if path:
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    feature_columns = [col for generator in [feature_generators.Pickup(), feature_generators.Trip(), feature_generators.Categorical()]
+                       for col in generator.schema()]
+    df = io.load_output_df(
+        f'features/{month}', columns=feature_columns, sample_frac=sample_frac)
+    # NaN is not valid JSON
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+def make_bodies(records: typing.List[dict], endpoint: str = ENDPOINT, batch_size: int = BATCH_SIZE) -> typing.List[typing.Tuple[bytes, int]]:
+    """Encodes the request bodies up front, so the client doesn't spend test time on JSON. Returns (body, number of records) pairs."""
+    assert endpoint in ['predict', 'predict_batch'], f'Unknown endpoint {endpoint}.'
+    assert records, 'There are no records to send.'
+    if endpoint == 'predict':
+        return [(json.dumps(record).encode(), 1) for record in records]
+    return [(json.dumps(records[start:start + batch_size]).encode(), len(records[start:start + batch_size]))
+            for start in range(0, len(records), batch_size)]
+
+
+def run(url: str, bodies: typing.List[typing.Tuple[bytes, int]], concurrency: int = CONCURRENCY, rate: float = RATE, duration: float = DURATION, timeout: float = TIMEOUT, random_state: int = 42) -> dict:
+    """
+    This function sends requests to url for duration seconds, cycling through the bodies, and measures them.
+
+    Args:
+        url (str): endpoint url, i.e. "http://localhost:5000/predict"
+        bodies (List[Tuple[bytes, int]]): request bodies and their number of records, from make_bodies
+        concurrency (int, optional): number of clients
+        rate (float, optional): requests per second for an open loop test. 0 runs a closed loop test.
+        duration (float, optional): seconds to send requests for
+        timeout (float, optional): seconds before a request counts as an error
+        random_state (int, optional): seed for the open loop arrival times
+
+    Returns:
+        report (dict): counts, throughput, error rate, latency percentiles in milliseconds and errors by status code or exception
+    """
+    assert concurrency >= 1, 'At least one client is needed.'
+    latency = telemetry.Histogram('latency_seconds', 'Request latency.', scale=1e-6)
+    errors = collections.Counter()
+    completed = collections.Counter()
+    lock = threading.Lock()
+    sessions = threading.local()
+    headers = {'Content-Type': 'application/json'}
+
+    def send(i: int, due: int):
+        """Sends the ith request, timing it from due (a perf_counter_ns timestamp)."""
+        session = getattr(sessions, 'session', None)
+        if session is None:
+            session = sessions.session = requests.Session()
+        body, num_records = bodies[i % len(bodies)]
+        try:
+            response = session.post(url, data=body, headers=headers, timeout=timeout)
+            error = None if response.ok else str(response.status_code)
+        except requests.RequestException as e:
+            error = type(e).__name__
+        latency.record((time.perf_counter_ns() - due) // 1000)
+        with lock:
+            completed['requests'] += 1
+            if error is None:
+                completed['records'] += num_records
+            else:
+                errors[error] += 1
+
+    start = time.perf_counter_ns()
+    end = start + int(duration * 1e9)
+    if rate > 0:
+        # Open loop: arrivals are scheduled ahead of time and queue for a free client
+        gaps = np.random.RandomState(random_state).exponential(1e9 / rate, int(rate * duration * 2) + 10)
+        due_times = start + np.cumsum(gaps).astype(np.int64)
+        with ThreadPoolExecutor(concurrency) as pool:
+            for i, due in enumerate(due_times[due_times < end]):
+                delay = (int(due) - time.perf_counter_ns()) / 1e9
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(send, i, int(due))
+    else:
+        counter = itertools.count()
+
+        def client():
+            while time.perf_counter_ns() < end:
+                send(next(counter), time.perf_counter_ns())
+
+        threads = [threading.Thread(target=client) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = (time.perf_counter_ns() - start) / 1e9
+
+    num_errors = sum(errors.values())
+    return {
+        'requests': completed['requests'],
+        'records': completed['records'],
+        'seconds': elapsed,
+        'requests_per_second': completed['requests'] / elapsed,
+        'records_per_second': completed['records'] / elapsed,
+        'error_rate': num_errors / completed['requests'] if completed['requests'] else 0.0,
+        'latency_ms': {f'p{q:g}': latency.percentile(q) * 1000 for q in PERCENTILES + [100]},
+        'errors': dict(errors),
+    }
+
+
+def format_report(report: dict) -> str:
+    latencies = ', '.join(f'{name} {value:.2f}' for name,
+                          value in report['latency_ms'].items())
+    lines = [f'Requests: {report["requests"]} in {report["seconds"]:.1f}s ({report["requests_per_second"]:.1f}/s, '
+             f'{report["records_per_second"]:.1f} records/s)',
+             f'Latency (ms): {latencies}',
+             f'Error rate: {report["error_rate"]:.2%}']
+    lines += [f'  {error}: {count}' for error,
+              count in sorted(report['errors'].items())]
+    return '\n'.join(lines)
+
+
+def main():
+    bodies = make_bodies(load_records())
+    mode = f'open loop at {RATE:g} requests/s' if RATE > 0 else 'closed loop'
+    print(f'Sending {ENDPOINT} requests to {URL} for {DURATION:g}s with {CONCURRENCY} clients, {mode}.')
+    report = run(f'{URL.rstrip("/")}/{ENDPOINT}', bodies)
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+server.py
+
+Production server for the inference API (inference/app.py). It runs gunicorn with pre-forked workers, each with a pool of
+threads (the gthread worker), so requests are handled concurrently and wait on micro-batched predictions without blocking a process.
+
+The app and its libraries are imported once before forking, so workers share those pages. Each worker then loads the model
+(a memory-mapped artifact that all workers share), makes a warm-up prediction and starts checking for new versions.
+"""
+from gunicorn.app.base import BaseApplication
+from utils import telemetry
+
+import multiprocessing
+import os
+
+PORT = int(os.environ.get('PORT', 5000))
+NUM_WORKERS = int(os.environ.get('SERVE_WORKERS', multiprocessing.cpu_count()))
+NUM_THREADS = int(os.environ.get('SERVE_THREADS', 8))
+# Seconds a worker may take to finish in-flight requests on shutdown or restart
+GRACEFUL_TIMEOUT = int(os.environ.get('SERVE_GRACEFUL_TIMEOUT', 30))
+
+
+def pre_fork(server, worker):
+    """
+    Gives a new worker the lowest telemetry slot no live worker has, in the arbiter, so workers never write the same metrics
+    row. A replacement worker takes over its predecessor's slot and keeps adding to its counts.
+    """
+    used = {getattr(live, 'telemetry_slot', None)
+            for live in server.WORKERS.values()}
+    free = [slot for slot in range(
+        telemetry.MAX_PROCESSES) if slot not in used]
+    # With more workers than slots (i.e. while old and new workers overlap during a reload), some share a row and may lose counts
+    worker.telemetry_slot = free[0] if free else len(
+        server.WORKERS) % telemetry.MAX_PROCESSES
+
+
+def post_fork(server, worker):
+    telemetry.set_process_slot(worker.telemetry_slot)
+
+
+def post_worker_init(worker):
+    """Loads the model in each worker after it forks."""
+    from inference import app
+    app.start()
+
+
+class InferenceServer(BaseApplication):
+    """Runs the inference app in gunicorn with the options passed in, without a config file."""
+
+    def __init__(self, options: dict):
+        self.options = options
+        super(InferenceServer, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from inference import app
+        return app.app
+
+
+def main():
+    InferenceServer({
+        'bind': f'0.0.0.0:{PORT}',
+        'workers': NUM_WORKERS,
+        'worker_class': 'gthread',
+        'threads': NUM_THREADS,
+        'preload_app': True,
+        'graceful_timeout': GRACEFUL_TIMEOUT,
+        'pre_fork': pre_fork,
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+    }).run()
+
+
+if __name__ == '__main__':
+    main()
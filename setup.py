@@ -8,6 +8,7 @@ setup(
         'boto3',
         'flask',
         'fsspec',
+        'gunicorn',
         'numpy',
         'pandas',
         'pyarrow',
@@ -21,12 +22,16 @@ setup(
     ],
     entry_points={
         'console_scripts': [
+            'ingest=etl.ingest:main',
             'cleaning=etl.cleaning:main',
             'featuregen=etl.featuregen:main',
             'split=training.split:main',
             'train=training.train:main',
+            'search=training.search:main',
             'serve=inference.app:main',
+            'serve-prod=inference.server:main',
             'inference=inference.inference:main',
+            'loadtest=inference.loadtest:main',
         ],
     }
 )
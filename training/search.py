@@ -0,0 +1,66 @@
+from utils import io, models, search
+
+import os
+
+# Set SEARCH_TMPDIR to a memory-backed directory (i.e. /dev/shm) to keep the shared training matrix off disk
+SEARCH_TMPDIR = os.environ.get('SEARCH_TMPDIR')
+
+
+def main():
+    feature_columns = [
+        'pickup_weekday', 'pickup_hour', 'pickup_minute', 'work_hours',
+        'passenger_count', 'trip_distance', 'trip_time', 'trip_speed',
+        'PULocationID', 'DOLocationID', 'RatecodeID'
+    ]
+    label_column = 'high_tip_indicator'
+
+    base = 'training/files'
+    columns = feature_columns + [label_column]
+    train_file_path = io.get_output_path(f'{base}/train')
+    test_file_path = io.get_output_path(f'{base}/test')
+
+    param_grid = {
+        'max_depth': [6, 10, 14],
+        'min_samples_leaf': [1, 10, 100],
+        'max_features': ['sqrt', 0.5],
+    }
+
+    # Load train set, reading only the columns the model uses
+    train_df = io.load_output_df(f'{base}/train', columns=columns)
+    test_df = io.load_output_df(f'{base}/test', columns=columns)
+
+    # Search over the grid with successive halving, then train the best candidate on the full train set
+    mw = models.RandomForestModelWrapper(
+        feature_columns=feature_columns, model_params={})
+    results = search.search(mw, train_df, label_column, search.grid_candidates(param_grid),
+                            halving_factor=3, tmp_dir=SEARCH_TMPDIR)
+    for result in results:
+        print(result)
+
+    mw.train(train_df, label_column)
+
+    # Score model
+    train_score = mw.score(train_df, label_column)
+    test_score = mw.score(test_df, label_column)
+
+    mw.add_data_path('train_df', train_file_path)
+    mw.add_data_path('test_df', test_file_path)
+    mw.add_metric('train_f1', train_score)
+    mw.add_metric('test_f1', test_score)
+
+    # Print paths and metrics
+    print('Paths:')
+    print(mw.get_data_paths())
+    print('Best params:')
+    print(mw.model_params)
+    print('Metrics:')
+    print({name: value for name, value in mw.get_metrics().items() if name != 'search_results'})
+
+    # Save model, and the same version as a memory-mappable artifact for serving
+    version = io.get_timestamp_as_string()
+    print(mw.save('training/models', version=version))
+    print(mw.save_artifact('training/artifacts', version=version))
+
+
+if __name__ == '__main__':
+    main()
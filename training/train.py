@@ -1,16 +1,13 @@
 from utils import io, models
 
+import os
 import pandas as pd
 
+# Set TRAIN_CHUNKSIZE to train and score in chunks of that many rows, for windows that don't fit in memory
+TRAIN_CHUNKSIZE = int(os.environ.get('TRAIN_CHUNKSIZE', 0))
 
-def main():
-    # Load train set
-    base = 'training/files'
-    train_df = io.load_output_df(f'{base}/train')
-    train_file_path = io.get_output_path(f'{base}/train')
-    test_df = io.load_output_df(f'{base}/test')
-    test_file_path = io.get_output_path(f'{base}/test')
 
+def main():
     feature_columns = [
         'pickup_weekday', 'pickup_hour', 'pickup_minute', 'work_hours',
         'passenger_count', 'trip_distance', 'trip_time', 'trip_speed',
@@ -18,6 +15,11 @@ def main():
     ]
     label_column = 'high_tip_indicator'
 
+    base = 'training/files'
+    columns = feature_columns + [label_column]
+    train_file_path = io.get_output_path(f'{base}/train')
+    test_file_path = io.get_output_path(f'{base}/test')
+
     model_params = {
         'max_depth': 10
     }
@@ -25,11 +27,25 @@ def main():
     # Create and train model
     mw = models.RandomForestModelWrapper(
         feature_columns=feature_columns, model_params=model_params)
-    mw.train(train_df, label_column)
 
-    # Score model
-    train_score = mw.score(train_df, label_column)
-    test_score = mw.score(test_df, label_column)
+    if TRAIN_CHUNKSIZE:
+        def chunks(component):
+            return io.iter_output_df(component, columns=columns, batch_size=TRAIN_CHUNKSIZE)
+
+        mw.train_streaming(chunks(f'{base}/train'), label_column)
+
+        # Score model
+        train_score = mw.score_streaming(chunks(f'{base}/train'), label_column)
+        test_score = mw.score_streaming(chunks(f'{base}/test'), label_column)
+    else:
+        # Load train set, reading only the columns the model uses
+        train_df = io.load_output_df(f'{base}/train', columns=columns)
+        test_df = io.load_output_df(f'{base}/test', columns=columns)
+        mw.train(train_df, label_column)
+
+        # Score model
+        train_score = mw.score(train_df, label_column)
+        test_score = mw.score(test_df, label_column)
 
     mw.add_data_path('train_df', train_file_path)
     mw.add_data_path('test_df', test_file_path)
@@ -45,8 +61,10 @@ def main():
     # Print feature importances
     print(mw.get_feature_importances())
 
-    # Save model
-    print(mw.save('training/models'))
+    # Save model, and the same version as a memory-mappable artifact for serving
+    version = io.get_timestamp_as_string()
+    print(mw.save('training/models', version=version))
+    print(mw.save_artifact('training/artifacts', version=version))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,98 @@
+"""
+artifact.py
+
+This file contains a versioned binary format for model artifacts, which are loaded without unpickling. An artifact is:
+- an 8-byte magic string, a uint32 format version, 4 reserved bytes and a uint64 header length
+- a JSON header with the metadata (i.e. feature columns, data paths and metrics) and the dtype, shape and offset of each array
+- the arrays, each aligned to ALIGNMENT bytes, in little-endian C order
+
+Arrays are read as views into a read-only memory map of the file, so loading takes no time and processes that load the same
+file share one copy of it in the page cache.
+"""
+import json
+import mmap
+import numpy as np
+import struct
+import typing
+
+MAGIC = b'TAMLART\x00'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+# Magic, format version, reserved and header length
+PREAMBLE = struct.Struct('<8sIIQ')
+
+
+def _align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _to_json(obj: typing.Any) -> typing.Any:
+    """Converts numpy scalars and arrays in the metadata (i.e. metrics) to JSON types."""
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return obj.tolist()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable.')
+
+
+def dumps(metadata: dict, arrays: typing.Dict[str, np.ndarray]) -> bytes:
+    """
+    This function serializes metadata and named arrays into the artifact format.
+
+    Args:
+        metadata (dict): JSON-serializable information, i.e. feature columns
+        arrays (Dict[str, np.ndarray]): arrays to store, by name
+
+    Returns:
+        bytes: contents of the artifact file
+    """
+    layouts, blocks, offset = {}, [], 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<'))
+        offset = _align(offset)
+        layouts[name] = {'dtype': array.dtype.str,
+                         'shape': list(array.shape), 'offset': offset}
+        blocks.append((offset, array.tobytes()))
+        offset += array.nbytes
+
+    header = json.dumps({'metadata': metadata, 'arrays': layouts},
+                        default=_to_json).encode('utf-8')
+    data_start = _align(PREAMBLE.size + len(header))
+    contents = bytearray(data_start + offset)
+    contents[:PREAMBLE.size] = PREAMBLE.pack(
+        MAGIC, FORMAT_VERSION, 0, len(header))
+    contents[PREAMBLE.size:PREAMBLE.size + len(header)] = header
+    for block_offset, block in blocks:
+        contents[data_start + block_offset:data_start +
+                 block_offset + len(block)] = block
+    return bytes(contents)
+
+
+def load(path: str) -> typing.Tuple[dict, typing.Dict[str, np.ndarray]]:
+    """
+    This function memory maps an artifact file.
+
+    Args:
+        path (str): local path of the artifact
+
+    Returns:
+        Tuple[dict, Dict[str, np.ndarray]]: metadata and read-only arrays backed by the file
+    """
+    with open(path, 'rb') as f:
+        if f.seek(0, 2) < PREAMBLE.size:
+            raise ValueError(f'{path} is not a model artifact.')
+        # The arrays keep the map open after the file is closed
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, format_version, _, header_length = PREAMBLE.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError(f'{path} is not a model artifact.')
+    if format_version > FORMAT_VERSION:
+        raise ValueError(
+            f'{path} has format version {format_version}, but only versions up to {FORMAT_VERSION} can be read.')
+
+    header = json.loads(
+        buffer[PREAMBLE.size:PREAMBLE.size + header_length])
+    data_start = _align(PREAMBLE.size + header_length)
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        arrays[name] = np.frombuffer(buffer, dtype=layout['dtype'], count=int(np.prod(layout['shape'])),
+                                     offset=data_start + layout['offset']).reshape(layout['shape'])
+    return header['metadata'], arrays
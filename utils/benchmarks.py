@@ -0,0 +1,114 @@
+"""
+benchmarks.py
+
+This file contains micro-benchmarks for pipeline steps, run on synthetic data so they don't need access to the bucket:
+
+    python -m utils.benchmarks
+"""
+from .feature_generators import Categorical, FeaturePlan, HighTip, Pickup, Trip
+from .helpers import remove_zero_fare_and_oob_rows
+from .models import RandomForestModelWrapper
+
+import calendar
+import numpy as np
+import pandas as pd
+import timeit
+
+
+def make_synthetic_trips(n_rows: int, month: str = '01', year: str = '2020', seed: int = 42) -> pd.DataFrame:
+    """
+    This function creates a dataframe of random yellow taxicab trips with the raw data columns used by the pipeline.
+    Dropoffs spill a little outside the month and a few fares are zero, so cleaning has something to remove.
+
+    Args:
+        n_rows (int): number of trips
+        month (str): month formatted as a 2-digit string, i.e. "05" for May
+        year (str): year formatted as a 4-digit string, i.e. "2020" for 2020
+        seed (int): random seed
+
+    Returns:
+        pd.DataFrame: dataframe of synthetic trips
+    """
+    rng = np.random.default_rng(seed)
+    month_start = pd.Timestamp(f'{year}-{month}-01')
+    days = calendar.monthrange(int(year), int(month))[1]
+
+    pickup_offsets = rng.integers(-3600, days * 86400, n_rows)
+    trip_seconds = rng.integers(60, 3600, n_rows)
+    pickup = month_start + pd.to_timedelta(pickup_offsets, unit='s')
+    dropoff = pickup + pd.to_timedelta(trip_seconds, unit='s')
+    fare = rng.gamma(2.0, 6.0, n_rows).round(2).astype('float32')
+    fare[rng.random(n_rows) < 0.01] = 0
+
+    return pd.DataFrame({
+        'tpep_pickup_datetime': pickup.to_numpy(),
+        'tpep_dropoff_datetime': dropoff.to_numpy(),
+        'passenger_count': pd.array(rng.integers(1, 7, n_rows), dtype='Int8'),
+        'trip_distance': rng.gamma(1.5, 2.0, n_rows).round(2).astype('float32'),
+        'RatecodeID': rng.choice([1, 1, 1, 1, 2, 5], n_rows),
+        'PULocationID': rng.integers(1, 266, n_rows),
+        'DOLocationID': rng.integers(1, 266, n_rows),
+        'fare_amount': fare,
+        'tip_amount': (fare * rng.choice([0, 0.1, 0.2, 0.25], n_rows)).round(2).astype('float32'),
+    })
+
+
+def _remove_zero_fare_and_oob_rows_str(df: pd.DataFrame, start_date: str = None, end_date: str = None) -> pd.DataFrame:
+    """Original string-comparison implementation of helpers.remove_zero_fare_and_oob_rows, kept as the baseline."""
+    df = df[df.fare_amount > 0]
+    if start_date:
+        df = df[df.tpep_dropoff_datetime.astype('str') >= start_date]
+    if end_date:
+        df = df[df.tpep_dropoff_datetime.astype('str') <= end_date]
+
+    return df.reset_index(drop=True)
+
+
+def benchmark_cleaning(n_rows: int = 1_000_000, repeat: int = 3) -> dict:
+    """Returns the best-of-repeat seconds for the string baseline and the vectorized cleaning on n_rows synthetic trips."""
+    df = make_synthetic_trips(n_rows)
+    args = (df, '2020-01-01', '2020-01-31')
+    return {
+        'string_baseline': min(timeit.repeat(lambda: _remove_zero_fare_and_oob_rows_str(*args), number=1, repeat=repeat)),
+        'vectorized': min(timeit.repeat(lambda: remove_zero_fare_and_oob_rows(*args), number=1, repeat=repeat)),
+    }
+
+
+def benchmark_predict(n_rows: int = 100_000, batch_size: int = 1_000, repeat: int = 100) -> dict:
+    """
+    Returns the best-of-repeat seconds to score one record end to end (through a dataframe and directly), and to score one row
+    and a batch of preprocessed features with sklearn and with the compiled forest.
+    """
+    plan = FeaturePlan([Pickup(), Trip(), Categorical(), HighTip()])
+    df = plan.compute(make_synthetic_trips(n_rows))
+    label_column = 'high_tip_indicator'
+    mw = RandomForestModelWrapper(feature_columns=[col for col in plan.schema() if col != label_column],
+                                  model_params={'max_depth': 10})
+    mw.train(df, label_column)
+    mw.compile()
+    X = mw.preprocess(df.iloc[:batch_size]).copy()
+    record = df[mw.feature_columns].iloc[0].to_dict()
+
+    results = {}
+    # End to end from a parsed request, with and without building a dataframe
+    results['single_record_dataframe'] = min(timeit.repeat(
+        lambda: mw.predict(pd.DataFrame({k: [v] for k, v in record.items()})), number=1, repeat=repeat))
+    results['single_record_direct'] = min(timeit.repeat(
+        lambda: mw.predict_records([record]), number=1, repeat=repeat))
+    for name, rows in [('single_row', X[:1]), ('batch', X)]:
+        results[f'{name}_sklearn'] = min(timeit.repeat(
+            lambda: mw.model.predict_proba(rows), number=1, repeat=repeat))
+        results[f'{name}_compiled'] = min(timeit.repeat(
+            lambda: mw.compiled_model.predict_proba(rows), number=1, repeat=repeat))
+    return results
+
+
+def main():
+    for name, seconds in benchmark_cleaning().items():
+        print(f'cleaning {name}: {seconds:.3f}s')
+    for name, seconds in benchmark_predict().items():
+        print(f'predict {name}: {seconds * 1e6:.0f}us')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,15 +4,150 @@ feature_generators.py
 This file contains the abstraction for a FeatureGenerator, which should include:
 - name, required columns
 - compute method that returns the computed feature
-- schema method that returns schema for the feature returned
+- schema method that returns schema for the feature returned, with the compact dtype (i.e. int8, float32 or nullable Int16) the feature is stored as
+
+It also contains a FeaturePlan, which computes several generators together. Generators share intermediate
+columns (i.e. the pickup time in seconds) through a FeatureContext, so each intermediate is computed once, and
+write into one preallocated output frame instead of being concatenated.
+
+Generators also compute features for a single record (i.e. a raw trip sent to the inference API) with compute_record,
+using the same formulas on Python scalars, so online features match the batch features exactly.
 """
 
 from abc import ABC, abstractmethod
 from .helpers import assert_subset
 
+import datetime
+import hashlib
+import inspect
+import json
+import numpy as np
 import pandas as pd
 import typing
 
+MICROSECONDS_PER_SECOND = 1_000_000
+SECONDS_PER_DAY = 86400
+EPOCH_WEEKDAY = 3  # 1970-01-01 was a Thursday
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def _source_hash(obj: typing.Any) -> str:
+    """Returns a short hash of the source code of a function or class."""
+    return hashlib.sha256(inspect.getsource(obj).encode()).hexdigest()[:16]
+
+
+def _epoch_microseconds(col: pd.Series) -> np.ndarray:
+    """Returns a datetime column as int64 microseconds since the epoch."""
+    return col.to_numpy().astype('datetime64[us]').view(np.int64)
+
+
+def _mask_nat(values: np.ndarray, nat_mask: np.ndarray) -> np.ndarray:
+    """Sets values computed from missing timestamps to NaN, like the pandas .dt accessors do."""
+    if not nat_mask.any():
+        return values
+    values = values.astype('float64')
+    values[nat_mask] = np.nan
+    return values
+
+
+# Formulas shared by the batch (numpy array) and single record (Python scalar) paths
+def _weekday(seconds):
+    return (seconds // SECONDS_PER_DAY + EPOCH_WEEKDAY) % 7
+
+
+def _hour(seconds):
+    return (seconds // 3600) % 24
+
+
+def _minute(seconds):
+    return (seconds // 60) % 60
+
+
+def _trip_seconds(pickup_us, dropoff_us):
+    """Same as timedelta.seconds: whole seconds of the trip, ignoring days."""
+    return ((dropoff_us - pickup_us) // MICROSECONDS_PER_SECOND) % SECONDS_PER_DAY
+
+
+def _work_hours(weekday, hour):
+    return (weekday >= 0) & (weekday <= 4) & (hour >= 8) & (hour <= 18)
+
+
+def _trip_speed(trip_distance, trip_time):
+    return trip_distance / (trip_time + 1e7)
+
+
+FORMULAS = [_weekday, _hour, _minute, _trip_seconds, _work_hours, _trip_speed]
+
+# Intermediate columns shared by generators. Each is a function of the context, so intermediates can depend on other intermediates.
+INTERMEDIATES = {
+    'pickup_us': lambda ctx: _epoch_microseconds(ctx.df.tpep_pickup_datetime),
+    'dropoff_us': lambda ctx: _epoch_microseconds(ctx.df.tpep_dropoff_datetime),
+    'pickup_nat': lambda ctx: ctx.df.tpep_pickup_datetime.isna().to_numpy(),
+    'trip_nat': lambda ctx: ctx['pickup_nat'] | ctx.df.tpep_dropoff_datetime.isna().to_numpy(),
+    'pickup_seconds': lambda ctx: ctx['pickup_us'] // MICROSECONDS_PER_SECOND,
+    'pickup_weekday': lambda ctx: _mask_nat(_weekday(ctx['pickup_seconds']), ctx['pickup_nat']),
+    'pickup_hour': lambda ctx: _mask_nat(_hour(ctx['pickup_seconds']), ctx['pickup_nat']),
+    'pickup_minute': lambda ctx: _mask_nat(_minute(ctx['pickup_seconds']), ctx['pickup_nat']),
+    'trip_time': lambda ctx: _mask_nat(_trip_seconds(ctx['pickup_us'], ctx['dropoff_us']), ctx['trip_nat']),
+}
+
+
+def _record_microseconds(record: dict, col: str) -> typing.Optional[int]:
+    """Returns a timestamp in a record (an ISO 8601 string or a datetime) as microseconds since the epoch, or None if it is missing."""
+    value = record.get(col)
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f'{col} must be an ISO 8601 timestamp.')
+    if not isinstance(value, datetime.datetime) or value.tzinfo is not None:
+        raise ValueError(f'{col} must be a timestamp without a time zone.')
+    return (value - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def _record_int(record: dict, col: str) -> typing.Optional[int]:
+    """Returns an integer (i.e. an ID) in a record, or None if it is missing."""
+    value = record.get(col)
+    if value is None or value != value:
+        return None
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{col} must be an integer or null.')
+    if not value.is_integer():
+        raise ValueError(f'{col} must be an integer or null.')
+    return int(value)
+
+
+def _record_float32(record: dict, col: str) -> typing.Optional[float]:
+    """Returns a number in a record rounded to float32, the dtype it has in the batch data, or None if it is missing."""
+    value = record.get(col)
+    if value is None:
+        return None
+    try:
+        return float(np.float32(value))
+    except (TypeError, ValueError):
+        raise ValueError(f'{col} must be a number or null.')
+
+
+class FeatureContext:
+    """Lazily computes and caches the intermediate columns in INTERMEDIATES for one dataframe."""
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._values = {}
+        self._in_progress = set()
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self._values:
+            assert name not in self._in_progress, f'Intermediate {name} depends on itself.'
+            self._in_progress.add(name)
+            self._values[name] = INTERMEDIATES[name](self)
+            self._in_progress.remove(name)
+        return self._values[name]
+
 
 class FeatureGenerator(ABC):
     """Abstract class for a feature generator."""
@@ -30,6 +165,27 @@ class FeatureGenerator(ABC):
     def schema(self):
         pass
 
+    def code_version(self) -> str:
+        """Returns a hash of the generator's code, which changes whenever the class is edited."""
+        return _source_hash(type(self))
+
+    def compute_columns(self, ctx: FeatureContext) -> dict:
+        """Returns a dictionary from feature name to values. Generators override this to share intermediates through ctx; by default it calls compute."""
+        feature_df = self.compute(ctx.df)
+        return {col: feature_df[col] for col in feature_df.columns}
+
+    def compute_record(self, record: dict) -> dict:
+        """
+        Computes the features of one record (a dictionary of raw columns) as Python values, with None for missing values. Must match
+        compute exactly. Generators override this with a scalar fast path; by default it calls compute on a one-row dataframe.
+        """
+        df = pd.DataFrame([{col: record.get(col) for col in self.required_columns}])
+        return {col: None if pd.isna(value) else value for col, value in self.compute(df).iloc[0].items()}
+
+    def _to_frame(self, columns: dict, index: pd.Index) -> pd.DataFrame:
+        """Builds the dataframe returned by compute from the output of compute_columns, with the dtypes in the schema."""
+        return pd.DataFrame(columns, index=index)[list(self.schema().keys())].astype(self.schema())
+
 
 class HighTip(FeatureGenerator):
     def __init__(self):
@@ -39,10 +195,13 @@ class HighTip(FeatureGenerator):
     def compute(self, df: pd.DataFrame, tip_fraction: float = 0.2) -> pd.DataFrame:
         """Computes whether the tip was at least tip_fraction of the fare."""
         assert_subset(self.required_columns, df.columns)
-        tip_fraction_col = df.tip_amount / df.fare_amount
-        feature_df = pd.DataFrame(
-            {'high_tip_indicator': tip_fraction_col > tip_fraction})
-        return feature_df[self.schema().keys()]
+        return self._to_frame(self.compute_columns(FeatureContext(df), tip_fraction), df.index)
+
+    def compute_columns(self, ctx: FeatureContext, tip_fraction: float = 0.2) -> dict:
+        # Amounts may be float32, so compare in float64 on whole cents to keep exact-fraction tips stable
+        tip_fraction_col = ctx.df.tip_amount.astype(
+            'float64').round(2) / ctx.df.fare_amount.astype('float64').round(2)
+        return {'high_tip_indicator': (tip_fraction_col > tip_fraction).to_numpy()}
 
     def schema(self) -> dict:
         return {'high_tip_indicator': bool}
@@ -55,17 +214,28 @@ class Pickup(FeatureGenerator):
     def compute(self, df: pd.DataFrame) -> pd.DataFrame:
         """Computes features related to the pickup time, such as weekday, hour, minute, and whether the pickup was during working hours."""
         assert_subset(self.required_columns, df.columns)
-        pickup_weekday = df.tpep_pickup_datetime.dt.weekday
-        pickup_hour = df.tpep_pickup_datetime.dt.hour
-        pickup_minute = df.tpep_pickup_datetime.dt.minute
-        work_hours = (pickup_weekday >= 0) & (pickup_weekday <= 4) & (
-            pickup_hour >= 8) & (pickup_hour <= 18)
-        feature_df = pd.DataFrame({'pickup_weekday': pickup_weekday,
-                                   'pickup_hour': pickup_hour, 'pickup_minute': pickup_minute, 'work_hours': work_hours})
-        return feature_df[self.schema().keys()]
+        return self._to_frame(self.compute_columns(FeatureContext(df)), df.index)
+
+    def compute_columns(self, ctx: FeatureContext) -> dict:
+        pickup_weekday = ctx['pickup_weekday']
+        pickup_hour = ctx['pickup_hour']
+        return {'pickup_weekday': pickup_weekday, 'pickup_hour': pickup_hour,
+                'pickup_minute': ctx['pickup_minute'], 'work_hours': _work_hours(pickup_weekday, pickup_hour)}
+
+    def compute_record(self, record: dict) -> dict:
+        pickup_us = _record_microseconds(record, 'tpep_pickup_datetime')
+        if pickup_us is None:
+            # Like compute, where comparisons with a missing hour are False
+            return {'pickup_weekday': None, 'pickup_hour': None, 'pickup_minute': None, 'work_hours': False}
+        pickup_seconds = pickup_us // MICROSECONDS_PER_SECOND
+        pickup_weekday, pickup_hour = _weekday(
+            pickup_seconds), _hour(pickup_seconds)
+        return {'pickup_weekday': pickup_weekday, 'pickup_hour': pickup_hour,
+                'pickup_minute': _minute(pickup_seconds), 'work_hours': _work_hours(pickup_weekday, pickup_hour)}
 
     def schema(self) -> dict:
-        return {'pickup_weekday': int, 'pickup_hour': int, 'pickup_minute': int, 'work_hours': bool}
+        # Missing pickup times (NaT) give missing values, so the time parts are nullable integers
+        return {'pickup_weekday': pd.Int8Dtype(), 'pickup_hour': pd.Int8Dtype(), 'pickup_minute': pd.Int8Dtype(), 'work_hours': bool}
 
 
 class Trip(FeatureGenerator):
@@ -76,15 +246,30 @@ class Trip(FeatureGenerator):
     def compute(self, df: pd.DataFrame) -> pd.DataFrame:
         """Computes trip-related features, such as passenger count, trip distance, time taken for the trip, and average speed."""
         assert_subset(self.required_columns, df.columns)
-        trip_time = (df.tpep_dropoff_datetime -
-                     df.tpep_pickup_datetime).dt.seconds
-        trip_speed = df.trip_distance / (trip_time + 1e7)
-        feature_df = pd.DataFrame({'trip_time': trip_time, 'trip_speed': trip_speed,
-                                   'trip_distance': df.trip_distance, 'passenger_count': df.passenger_count})
-        return feature_df[self.schema().keys()]
+        return self._to_frame(self.compute_columns(FeatureContext(df)), df.index)
+
+    def compute_columns(self, ctx: FeatureContext) -> dict:
+        trip_time = ctx['trip_time']
+        trip_distance = ctx.df.trip_distance.to_numpy()
+        trip_speed = _trip_speed(trip_distance, trip_time)
+        return {'trip_time': trip_time, 'trip_speed': trip_speed,
+                'trip_distance': trip_distance, 'passenger_count': ctx.df.passenger_count.array}
+
+    def compute_record(self, record: dict) -> dict:
+        pickup_us = _record_microseconds(record, 'tpep_pickup_datetime')
+        dropoff_us = _record_microseconds(record, 'tpep_dropoff_datetime')
+        trip_time = None if pickup_us is None or dropoff_us is None else _trip_seconds(
+            pickup_us, dropoff_us)
+        # trip_distance is float32 in the batch data, so it is rounded to float32 before the speed is computed
+        trip_distance = _record_float32(record, 'trip_distance')
+        trip_speed = None if trip_time is None or trip_distance is None else float(
+            np.float32(_trip_speed(trip_distance, trip_time)))
+        return {'trip_time': trip_time, 'trip_speed': trip_speed,
+                'trip_distance': trip_distance, 'passenger_count': _record_int(record, 'passenger_count')}
 
     def schema(self) -> dict:
-        return {'passenger_count': int, 'trip_distance': float, 'trip_time': int, 'trip_speed': float}
+        # passenger_count is missing for some trips, and trip_time is missing when either timestamp is
+        return {'passenger_count': pd.Int8Dtype(), 'trip_distance': np.float32, 'trip_time': pd.Int32Dtype(), 'trip_speed': np.float32}
 
 
 class Categorical(FeatureGenerator):
@@ -93,9 +278,83 @@ class Categorical(FeatureGenerator):
                                                           'DOLocationID', 'RatecodeID'])
 
     def compute(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Identity function for categorical features."""
+        """Identity function for categorical features. IDs read as pandas categoricals are decoded back to their numeric values."""
         assert_subset(self.required_columns, df.columns)
-        return df[self.schema().keys()]
+        return self._to_frame(self.compute_columns(FeatureContext(df)), df.index)
+
+    def compute_columns(self, ctx: FeatureContext) -> dict:
+        return {col: ctx.df[col].to_numpy(dtype='float64', na_value=np.nan) for col in self.schema().keys()}
+
+    def compute_record(self, record: dict) -> dict:
+        return {col: _record_int(record, col) for col in self.schema().keys()}
 
     def schema(self) -> dict:
-        return {col: int for col in self.required_columns}
+        # IDs can be missing (i.e. RatecodeID), so they are nullable integers
+        return {'PULocationID': pd.Int16Dtype(), 'DOLocationID': pd.Int16Dtype(), 'RatecodeID': pd.Int8Dtype()}
+
+
+class FeaturePlan:
+    """Computes the features of several generators at once, sharing intermediates and writing into one preallocated frame."""
+
+    def __init__(self, generators: typing.List[FeatureGenerator], passthrough_columns: typing.List[str] = []):
+        """Constructor resolves the columns required by the generators and the schema of the output. Passthrough columns are copied from the input as-is."""
+        self.generators = generators
+        self.passthrough_columns = passthrough_columns
+        self.required_columns = list(dict.fromkeys(
+            [col for generator in generators for col in generator.required_columns] + passthrough_columns))
+
+        self.output_schema = {}
+        for generator in generators:
+            for col, dtype in generator.schema().items():
+                assert col not in self.output_schema, f'Feature {col} is computed by more than one generator.'
+                self.output_schema[col] = dtype
+        assert not set(passthrough_columns) & set(
+            self.output_schema), 'Passthrough columns overlap with computed features.'
+
+    def schema(self) -> dict:
+        """Returns the schema of the computed features (not including passthrough columns)."""
+        return self.output_schema
+
+    def fingerprint(self, input_path: str) -> str:
+        """Returns a hash of the input version and the code of the generators and intermediates, so unchanged outputs can be skipped."""
+        fingerprint = {
+            'input': input_path,
+            'generators': {generator.name: generator.code_version() for generator in self.generators},
+            'intermediates': {name: _source_hash(fn) for name, fn in INTERMEDIATES.items()},
+            'formulas': {fn.__name__: _source_hash(fn) for fn in FORMULAS},
+            'passthrough_columns': self.passthrough_columns,
+        }
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+    def compute(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Computes all features for a dataframe. Numpy-typed features are written into arrays allocated up front from the schema."""
+        assert_subset(self.required_columns, df.columns)
+        ctx = FeatureContext(df)
+
+        output = {}
+        for col, dtype in self.output_schema.items():
+            dtype = pd.api.types.pandas_dtype(dtype)
+            output[col] = np.empty(len(df), dtype=dtype) if isinstance(
+                dtype, np.dtype) else None
+
+        for generator in self.generators:
+            for col, values in generator.compute_columns(ctx).items():
+                if output[col] is None:
+                    output[col] = pd.array(
+                        values, dtype=self.output_schema[col])
+                else:
+                    np.copyto(output[col], values, casting='same_kind')
+
+        for col in self.passthrough_columns:
+            output[col] = df[col].array
+
+        return pd.DataFrame(output, index=df.index, copy=False)
+
+    def compute_record(self, record: dict) -> dict:
+        """Computes all features for one record (a dictionary of raw columns), like compute does for a dataframe. Missing values are None."""
+        features = {}
+        for generator in self.generators:
+            features.update(generator.compute_record(record))
+        for col in self.passthrough_columns:
+            features[col] = record.get(col)
+        return features
@@ -0,0 +1,95 @@
+"""
+forest.py
+
+This file contains a compiled form of a trained sklearn random forest, for low-latency scoring. The trees are flattened into contiguous
+node arrays (feature, threshold, children and leaf probability), and rows are routed through every tree at once with vectorized
+numpy operations instead of sklearn's per-tree Python calls and joblib dispatch.
+"""
+from sklearn.ensemble import RandomForestClassifier
+
+import numpy as np
+
+# Rows scored at a time, which keeps the (rows, trees) node index arrays small enough to stay in cache
+BATCH_SIZE = 1_000
+# Above this many rows, sklearn's compiled per-tree loop (run on all cores) is faster than gathering through numpy
+MAX_COMPILED_ROWS = 1_000
+
+
+class CompiledForest(object):
+    """Flat-array random forest. Node i of the forest belongs to one tree, and leaves are their own children."""
+
+    def __init__(self, feature: np.ndarray, threshold: np.ndarray, children: np.ndarray, value: np.ndarray, roots: np.ndarray, max_depth: int):
+        """
+        Constructor. Arrays are indexed by node, except roots, which holds the index of each tree's first node.
+        children holds the left and right child of node i at 2 * i and 2 * i + 1.
+        """
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.max_depth = max_depth
+
+    @classmethod
+    def from_sklearn(cls, model: RandomForestClassifier):
+        """
+        This function flattens a fitted binary random forest classifier into node arrays.
+
+        Args:
+            model (RandomForestClassifier): fitted forest
+
+        Returns:
+            CompiledForest: forest whose predict_proba matches model.predict_proba(X)[:, 1]
+        """
+        assert len(model.classes_) == 2, 'Only binary classifiers can be compiled.'
+        features, thresholds, children, values, roots = [], [], [], [], []
+        offset = 0
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            nodes = np.arange(tree.node_count)
+            is_leaf = tree.children_left == -1
+
+            features.append(np.where(is_leaf, 0, tree.feature))
+            thresholds.append(tree.threshold)
+            children.append(np.stack([np.where(is_leaf, nodes, tree.children_left),
+                                      np.where(is_leaf, nodes, tree.children_right)], axis=1).ravel() + offset)
+            # Same normalization as DecisionTreeClassifier.predict_proba
+            normalizer = tree.value[:, 0, :].sum(axis=1)
+            normalizer[normalizer == 0.0] = 1.0
+            values.append(tree.value[:, 0, 1] / normalizer)
+            roots.append(offset)
+            offset += tree.node_count
+
+        return cls(feature=np.concatenate(features).astype(np.intp), threshold=np.concatenate(thresholds).astype(np.float64),
+                   children=np.concatenate(children).astype(np.intp),
+                   value=np.concatenate(values).astype(np.float64), roots=np.array(roots, dtype=np.intp),
+                   max_depth=max(estimator.tree_.max_depth for estimator in model.estimators_))
+
+    def arrays(self) -> dict:
+        """Returns the node arrays by constructor argument name, i.e. to store them in a model artifact."""
+        return {'feature': self.feature, 'threshold': self.threshold, 'children': self.children,
+                'value': self.value, 'roots': self.roots}
+
+    @property
+    def n_estimators(self) -> int:
+        return len(self.roots)
+
+    def apply(self, X: np.ndarray) -> np.ndarray:
+        """Returns the (rows, trees) leaf that each row of X reaches in each tree."""
+        X = np.ascontiguousarray(X)
+        # Offset of each row in the flattened matrix
+        row_offsets = (np.arange(len(X)) * X.shape[1])[:, None]
+        values = X.ravel()
+        nodes = np.broadcast_to(self.roots, (len(X), len(self.roots)))
+        for _ in range(self.max_depth):
+            # float32 features are compared against float64 thresholds, as in sklearn (which also sends NaN right)
+            go_right = ~(values[row_offsets + self.feature[nodes]] <= self.threshold[nodes])
+            nodes = self.children[2 * nodes + go_right]
+        return nodes
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        """Returns the probability of class 1 for each row of a preprocessed float32 matrix."""
+        if len(X) > BATCH_SIZE:
+            return np.concatenate([self.predict_proba(X[start:start + BATCH_SIZE]) for start in range(0, len(X), BATCH_SIZE)])
+        # Trees are summed in order (cumsum is sequential, unlike sum) and then averaged, like sklearn
+        return np.cumsum(self.value[self.apply(X)], axis=1)[:, -1] / self.n_estimators
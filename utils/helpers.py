@@ -1,4 +1,5 @@
 import datetime
+import numpy as np
 import pandas as pd
 import random
 import string
@@ -36,6 +37,7 @@ def get_timestamp_as_string() -> str:
 def remove_zero_fare_and_oob_rows(df: pd.DataFrame, start_date: str = None, end_date: str = None) -> pd.DataFrame:
     """
     This function removes rows with zero-valued fare amounts and out of bounds of the start and end dates.
+    Works on a whole month or on one chunk of it at a time.
 
     Args:
         df: pd dataframe representing data
@@ -45,13 +47,36 @@ def remove_zero_fare_and_oob_rows(df: pd.DataFrame, start_date: str = None, end_
     Returns:
         pd: DataFrame representing the cleaned dataframe
     """
-    df = df[df.fare_amount > 0]  # avoid divide-by-zero
+    mask = get_zero_fare_and_oob_mask(df, start_date, end_date)
+    return df[mask].reset_index(drop=True)
+
+
+def get_zero_fare_and_oob_mask(df: pd.DataFrame, start_date: str = None, end_date: str = None) -> np.ndarray:
+    """
+    This function computes the rows to keep in remove_zero_fare_and_oob_rows as a single boolean mask, comparing dropoff times as datetime64.
+    Bounds behave like a comparison against the string form of the dropoff time, i.e. a date-only end_date excludes dropoffs on that day.
+
+    Args:
+        df: pd dataframe representing data
+        start_date (optional): minimum date in the resulting dataframe
+        end_date (optional): maximum date in the resulting dataframe
+
+    Returns:
+        np.ndarray: boolean mask that is True for rows with a positive fare within the bounds
+    """
+    mask = (df.fare_amount > 0).to_numpy()  # avoid divide-by-zero
+    if not (start_date or end_date):
+        return mask
+
+    dropoff = df.tpep_dropoff_datetime.to_numpy()
     if start_date:
-        df = df[df.tpep_dropoff_datetime.astype('str') >= start_date]
+        mask = mask & (dropoff >= np.datetime64(pd.Timestamp(start_date)))
     if end_date:
-        df = df[df.tpep_dropoff_datetime.astype('str') <= end_date]
+        end = np.datetime64(pd.Timestamp(end_date))
+        mask = mask & ((dropoff < end) if len(end_date) <= len(
+            'YYYY-MM-DD') else (dropoff <= end))
 
-    return df.reset_index(drop=True)
+    return mask
 
 
 def get_file_at_latest_timestamp(filenames: typing.List[str]) -> str:
@@ -2,41 +2,148 @@
 io.py
 
 This file contains helper functions for reading and writing files.
+
+Each component directory keeps a small manifest (_manifest.json) of the versions written to it, so resolving the
+latest version is a single small read instead of a listing of the whole directory. Manifests are cached in-process
+for MANIFEST_CACHE_TTL seconds.
 """
-import boto3
+import json
 import os
 import pandas as pd
 import pickle
-import s3fs
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import random
+import threading
+import time
 import typing
 
 from .helpers import *
-
-BUCKET_NAME = 'toy-applied-ml-pipeline'
-
-
-def read_file(month: str, year: str) -> pd.DataFrame:
+from .storage import BUCKET_NAME, get_backend
+
+MANIFEST_FILENAME = '_manifest.json'
+DATASET_EXTENSION = '.dataset.json'
+MANIFEST_CACHE_TTL = float(os.environ.get('MANIFEST_CACHE_TTL', 60))
+
+_manifest_cache = {}
+_manifest_cache_lock = threading.Lock()
+
+RAW_CACHE_DIR = os.environ.get('RAW_CACHE_DIR', os.path.join(
+    os.path.expanduser('~'), '.cache', BUCKET_NAME, 'raw'))
+RAW_CACHE_ROW_GROUP_SIZE = 500_000
+# Local copies of outputs from remote backends that are read by path, i.e. memory-mapped model artifacts
+OUTPUT_CACHE_DIR = os.environ.get('OUTPUT_CACHE_DIR', os.path.join(
+    os.path.expanduser('~'), '.cache', BUCKET_NAME, 'outputs'))
+# Rows per row group in component outputs; the unit that sampling and filters skip over
+ROW_GROUP_SIZE = 100_000
+
+# IDs are categoricals over their documented codes, money is float32 and counts are nullable int8
+LOCATION_IDS = pd.CategoricalDtype(range(1, 266))
+MONEY_COLUMNS = ['fare_amount', 'extra', 'mta_tax', 'tip_amount', 'tolls_amount',
+                 'improvement_surcharge', 'total_amount', 'congestion_surcharge']
+RAW_DTYPES = {
+    'VendorID': pd.CategoricalDtype([1, 2, 4, 5, 6]),
+    'passenger_count': 'Int8',
+    'trip_distance': 'float32',
+    'RatecodeID': pd.CategoricalDtype([1, 2, 3, 4, 5, 6, 99]),
+    'store_and_fwd_flag': pd.CategoricalDtype(['N', 'Y']),
+    'PULocationID': LOCATION_IDS,
+    'DOLocationID': LOCATION_IDS,
+    'payment_type': pd.CategoricalDtype([0, 1, 2, 3, 4, 5, 6]),
+    **{col: 'float32' for col in MONEY_COLUMNS}
+}
+
+
+def read_file(month: str, year: str, chunksize: int = None, use_cache: bool = True) -> typing.Union[pd.DataFrame, typing.Iterator[pd.DataFrame]]:
     """
     This function reads from the NYC taxicab public s3 bucket to get a dataframe of all yellow trips for the specified month and year.
+    Columns are read with the compact dtypes in RAW_DTYPES. If the month was converted to parquet by cache_raw_file, it is read from the local cache instead.
 
     Args:
         month (str): month formatted as a 2-digit string, i.e. "05" for May
         year (str): year formatted as a 4-digit string, i.e. "2020" for 2020
+        chunksize (int, optional): if specified, return an iterator of dataframes with at most this many rows each, so the month is never fully in memory
+        use_cache (bool, optional): whether to read from the local parquet cache if it exists
 
     Returns:
-        pd.DataFrame: dataframe corresponding to all the yellow taxicab trips for the given parameters
+        pd.DataFrame: dataframe corresponding to all the yellow taxicab trips for the given parameters (or an iterator of dataframes if chunksize is specified)
     """
+    cache_path = get_raw_cache_path(month, year)
+    if use_cache and os.path.exists(cache_path):
+        if chunksize is None:
+            return _apply_raw_dtypes(pd.read_parquet(cache_path))
+        batches = pq.ParquetFile(cache_path).iter_batches(batch_size=chunksize)
+        return (_apply_raw_dtypes(batch.to_pandas()) for batch in batches)
+
+    return _read_raw_csv(month, year, chunksize)
+
+
+def _read_raw_csv(month: str, year: str, chunksize: int = None) -> typing.Union[pd.DataFrame, typing.Iterator[pd.DataFrame]]:
+    """Reads a month of raw data from the csv in the public bucket. See read_file."""
     # Get filename
     file_path = get_raw_data_filename(month, year)
 
     # Load data
     df = pd.read_csv(
-        file_path,
+        file_path, dtype=RAW_DTYPES, chunksize=chunksize,
         parse_dates=['tpep_pickup_datetime', 'tpep_dropoff_datetime'], memory_map=True)
 
     return df
 
 
+def _apply_raw_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """Parquet doesn't round-trip categoricals with integer categories, so restore RAW_DTYPES after reading from the cache."""
+    return df.astype({col: dtype for col, dtype in RAW_DTYPES.items() if col in df.columns})
+
+
+def cache_raw_file(month: str, year: str, overwrite: bool = False) -> str:
+    """
+    This function converts a month of raw csv data to parquet in the local cache (RAW_CACHE_DIR), so later reads skip csv parsing.
+    The file is written in row groups of RAW_CACHE_ROW_GROUP_SIZE rows with column statistics, and only appears once it is complete.
+
+    Args:
+        month (str): month formatted as a 2-digit string, i.e. "05" for May
+        year (str): year formatted as a 4-digit string, i.e. "2020" for 2020
+        overwrite (bool, optional): whether to convert the month again if it is already cached
+
+    Returns:
+        path (str): local path of the cached parquet file
+    """
+    cache_path = get_raw_cache_path(month, year)
+    if os.path.exists(cache_path) and not overwrite:
+        return cache_path
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f'{cache_path}.tmp'
+    writer = None
+    for chunk in _read_raw_csv(month, year, chunksize=RAW_CACHE_ROW_GROUP_SIZE):
+        table = pa.Table.from_pandas(
+            chunk, schema=writer.schema if writer else None, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(tmp_path, table.schema)
+        writer.write_table(table, row_group_size=RAW_CACHE_ROW_GROUP_SIZE)
+    assert writer is not None, 'Raw data file is empty.'
+    writer.close()
+
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+
+def get_raw_cache_path(month: str, year: str) -> str:
+    """
+    This function gets the local path that the parquet cache of a month of raw data lives at. Months are partitioned by year and month.
+
+    Args:
+        month (str): month formatted as a 2-digit string, i.e. "05" for May
+        year (str): year formatted as a 4-digit string, i.e. "2020" for 2020
+
+    Returns:
+        str: local path corresponding to the cached data
+    """
+    return os.path.join(RAW_CACHE_DIR, 'yellow_tripdata', f'year={year}', f'month={month}', 'part-0.parquet')
+
+
 def get_raw_data_filename(month: str, year: str) -> str:
     """This function gets the filename corresponding to the raw data 
     from the NYC taxicab public s3 bucket for the given month and year.
@@ -62,8 +169,8 @@ def write_file(df: pd.DataFrame, suffix: str, scratch: bool = True) -> str:
     This function takes a dataframe and writes it to the path specified in the args, without the index, as a parquet file.
 
     Args:
-        df (pd.DataFrame): Pandas DataFrame to write to S3 as a parquet file
-        suffix (str): path to add to the S3 bucket prefix. Must end with ".pq" or ".parquet"
+        df (pd.DataFrame): Pandas DataFrame to write to storage as a parquet file
+        suffix (str): path to add to the storage root (i.e. the S3 bucket). Must end with ".pq" or ".parquet"
         scratch (bool): whether the path should be prefixed with scratch
 
     Returns:
@@ -73,13 +180,12 @@ def write_file(df: pd.DataFrame, suffix: str, scratch: bool = True) -> str:
     assert suffix.endswith('.parquet') or suffix.endswith(
         '.pq'), 'Path suffix supplied must end with .pq or .parquet'
 
-    path = f's3://{BUCKET_NAME}'
-    if scratch:
-        path = os.path.join(path, 'scratch')
-    path = os.path.join(path, suffix)
+    key = os.path.join('scratch', suffix) if scratch else suffix
 
-    df.to_parquet(path, index=False)
-    return path
+    backend = get_backend()
+    with backend.open(key, 'wb') as f:
+        df.to_parquet(f, index=False, row_group_size=ROW_GROUP_SIZE)
+    return backend.url(key)
 
 
 def create_output_path(component: str, dev: bool = True, version: str = None) -> str:
@@ -94,12 +200,9 @@ def create_output_path(component: str, dev: bool = True, version: str = None) ->
     Returns:
         output_path (str): Full path for the file
     """
-    assert len(component) > 0, 'Component name should not be empty.'
-
-    prefix = os.path.join(
-        'dev', component) if dev else os.path.join('prod', component)
+    prefix = _get_component_prefix(component, dev)
 
-    assert list_files(
+    assert get_backend().exists(
         prefix), 'Component does not exist. Specify the correct component or contact an administrator to create it.'
 
     # Create version if doesn't exist
@@ -111,7 +214,7 @@ def create_output_path(component: str, dev: bool = True, version: str = None) ->
     return output_path
 
 
-def save_output_pkl(obj: object, component: str, dev: bool = True, overwrite: bool = False, version: str = None) -> str:
+def save_output_pkl(obj: object, component: str, dev: bool = True, overwrite: bool = False, version: str = None, metadata: dict = None) -> str:
     """
     This function serializes an object as part of a component's output.
 
@@ -121,27 +224,47 @@ def save_output_pkl(obj: object, component: str, dev: bool = True, overwrite: bo
         dev (bool, optional): whether this is run in development or "production" mode
         overwrite (bool, optional): whether to overwrite a file with the same name
         version (str, optional): optional version for the output. If not specified, the function will create the version number.
+        metadata (dict, optional): JSON-serializable information about the output to record in the component's manifest (see get_output_metadata)
+
+    Returns:
+        path (str): Full path that the file can be accessed at
+    """
+    pkl_obj = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    return save_output_bytes(pkl_obj, '.pkl', component, dev, overwrite, version, metadata)
+
+
+def save_output_bytes(data: bytes, extension: str, component: str, dev: bool = True, overwrite: bool = False, version: str = None, metadata: dict = None) -> str:
+    """
+    This function writes already serialized data (i.e. a model artifact) as part of a component's output.
+
+    Args:
+        data (bytes): contents of the file
+        extension (str): file extension, i.e. ".pkl"
+        component (str): name of the component that produced the output (ex: clean)
+        dev (bool, optional): whether this is run in development or "production" mode
+        overwrite (bool, optional): whether to overwrite a file with the same name
+        version (str, optional): optional version for the output. If not specified, the function will create the version number.
+        metadata (dict, optional): JSON-serializable information about the output to record in the component's manifest (see get_output_metadata)
 
     Returns:
         path (str): Full path that the file can be accessed at
     """
 
     output_path = create_output_path(component, dev, version)
-    filename = f'{output_path}.pkl'
+    filename = f'{output_path}{extension}'
 
     # Make sure file doesn't exist if overwrite is False
-    if list_files(filename) and overwrite is False:
+    if get_backend().exists(filename) and overwrite is False:
         raise OSError(
             'Trying to overwrite a with this component name and version. Please try another name / version or set overwrite to True.')
 
-    pkl_obj = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
-    s3_resource = boto3.resource('s3')
-    s3_resource.Object(BUCKET_NAME, filename).put(Body=pkl_obj)
-    filename = os.path.join(f's3://{BUCKET_NAME}', filename)
-    return filename
+    backend = get_backend()
+    backend.write_bytes(filename, data)
+    _update_manifest(_get_component_prefix(component, dev), filename, metadata)
+    return backend.url(filename)
 
 
-def save_output_df(df: pd.DataFrame, component: str, dev: bool = True, overwrite: bool = False, version: str = None) -> str:
+def save_output_df(df: pd.DataFrame, component: str, dev: bool = True, overwrite: bool = False, version: str = None, metadata: dict = None, schema: dict = None) -> str:
     """
     This function writes the output of a pipeline component (a dataframe) to a parquet file.
 
@@ -151,6 +274,41 @@ def save_output_df(df: pd.DataFrame, component: str, dev: bool = True, overwrite
         dev (bool, optional): whether this is run in development or "production" mode
         overwrite (bool, optional): whether to overwrite a file with the same name
         version (str, optional): optional version for the output. If not specified, the function will create the version number.
+        metadata (dict, optional): JSON-serializable information about the output to record in the component's manifest (see get_output_metadata)
+        schema (dict, optional): dtypes to cast columns to before writing, i.e. FeatureGenerator.schema()
+
+    Returns:
+        path (str): Full path that the file can be accessed at
+    """
+
+    output_path = create_output_path(component, dev, version)
+    filename = f'{output_path}.pq'
+
+    # Make sure file doesn't exist if overwrite is False
+    if get_backend().exists(filename) and overwrite is False:
+        raise OSError(
+            'Trying to overwrite a with this component name and version. Please try another name / version or set overwrite to True.')
+
+    if schema:
+        df = df.astype({col: dtype for col, dtype in schema.items() if col in df.columns})
+
+    path = write_file(df, filename, scratch=False)
+    _update_manifest(_get_component_prefix(component, dev), filename, metadata)
+    return path
+
+
+def save_output_chunks(chunks: typing.Iterable[pd.DataFrame], component: str, dev: bool = True, overwrite: bool = False, version: str = None, metadata: dict = None) -> str:
+    """
+    This function writes the output of a pipeline component, given as an iterable of dataframes with the same columns, to a single parquet file.
+    Chunks are written as they arrive, so only one chunk needs to be in memory at a time.
+
+    Args:
+        chunks (Iterable[pd.DataFrame]): dataframes representing consecutive pieces of the output
+        component (str): name of the component that produced the output (ex: clean)
+        dev (bool, optional): whether this is run in development or "production" mode
+        overwrite (bool, optional): whether to overwrite a file with the same name
+        version (str, optional): optional version for the output. If not specified, the function will create the version number.
+        metadata (dict, optional): JSON-serializable information about the output to record in the component's manifest (see get_output_metadata)
 
     Returns:
         path (str): Full path that the file can be accessed at
@@ -160,11 +318,119 @@ def save_output_df(df: pd.DataFrame, component: str, dev: bool = True, overwrite
     filename = f'{output_path}.pq'
 
     # Make sure file doesn't exist if overwrite is False
-    if list_files(filename) and overwrite is False:
+    if get_backend().exists(filename) and overwrite is False:
+        raise OSError(
+            'Trying to overwrite a with this component name and version. Please try another name / version or set overwrite to True.')
+
+    backend = get_backend()
+    writer = None
+    with backend.open(filename, 'wb') as f:
+        for chunk in chunks:
+            if writer is None:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                writer = pq.ParquetWriter(f, table.schema)
+            else:
+                table = pa.Table.from_pandas(
+                    chunk, schema=writer.schema, preserve_index=False)
+            writer.write_table(table, row_group_size=ROW_GROUP_SIZE)
+        assert writer is not None, 'No chunks to write.'
+        writer.close()
+
+    _update_manifest(_get_component_prefix(component, dev), filename, metadata)
+    return backend.url(filename)
+
+
+def save_output_dataset(inputs: typing.List[str], component: str, dev: bool = True, overwrite: bool = False, version: str = None, metadata: dict = None) -> str:
+    """
+    This function saves the output of a pipeline component as a dataset: a small file pointing at the latest versions of
+    other components' parquet outputs, instead of a copy of their data. Loading it (load_output_df or load_output_dataset) reads those files.
+
+    Args:
+        inputs (List[str]): names of the components whose latest outputs make up the dataset (ex: features/2020_10)
+        component (str): name of the component that produced the output (ex: training/files/train)
+        dev (bool, optional): whether this is run in development or "production" mode
+        overwrite (bool, optional): whether to overwrite a file with the same name
+        version (str, optional): optional version for the output. If not specified, the function will create the version number.
+        metadata (dict, optional): JSON-serializable information about the output to record in the component's manifest (see get_output_metadata)
+
+    Returns:
+        path (str): Full path that the file can be accessed at
+    """
+
+    output_path = create_output_path(component, dev, version)
+    filename = f'{output_path}{DATASET_EXTENSION}'
+
+    # Make sure file doesn't exist if overwrite is False
+    if get_backend().exists(filename) and overwrite is False:
         raise OSError(
             'Trying to overwrite a with this component name and version. Please try another name / version or set overwrite to True.')
 
-    return write_file(df, filename, scratch=False)
+    # Pin the versions that are current now, so the dataset doesn't change when new versions are written
+    files = []
+    for input_component in inputs:
+        files.extend(_get_dataset_files(
+            _get_output_key(input_component, dev)))
+
+    backend = get_backend()
+    backend.write_bytes(filename, json.dumps(
+        {'inputs': inputs, 'files': files}, indent=2).encode())
+    _update_manifest(_get_component_prefix(component, dev), filename, metadata)
+    return backend.url(filename)
+
+
+def load_output_dataset(component: str, dev: bool = True, version: str = None) -> ds.Dataset:
+    """
+    This function lazily opens the latest version of a component's output (a parquet file or a dataset of them) as an arrow dataset.
+    Nothing is read until the dataset is scanned; local files are memory mapped.
+
+    Args:
+        component (str): component name that we want to get the output from
+        dev (bool): whether this is run in development or "production" mode
+        version (str, optional): specified version of the data
+
+    Returns:
+        ds.Dataset: arrow dataset over the parquet files of the output
+    """
+    files = _get_dataset_files(_get_output_key(component, dev, version))
+    backend = get_backend()
+    return ds.dataset([backend.arrow_path(key) for key in files], format='parquet', filesystem=backend.arrow_filesystem())
+
+
+def iter_output_df(component: str, dev: bool = True, version: str = None, columns: typing.List[str] = None, filters: typing.List[tuple] = None, batch_size: int = 1_000_000) -> typing.Iterator[pd.DataFrame]:
+    """
+    This function streams the latest version of a component's output as dataframes of about batch_size rows, so it never has to fit in memory at once.
+
+    Args:
+        component (str): component name that we want to get the output from
+        dev (bool): whether this is run in development or "production" mode
+        version (str, optional): specified version of the data
+        columns (List[str], optional): columns to load. Defaults to all columns.
+        filters (List[tuple], optional): row filters in pyarrow format, i.e. [('tpep_pickup_datetime', '>=', pd.Timestamp('2020-12-01'))]
+        batch_size (int, optional): minimum number of rows per dataframe (the last one may be smaller)
+
+    Returns:
+        Iterator[pd.DataFrame]: consecutive pieces of the output
+    """
+    dataset = load_output_dataset(component, dev, version)
+    expression = pq.filters_to_expression(filters) if filters else None
+
+    # Arrow yields at most one row group per batch, so combine batches up to batch_size rows
+    batches, num_rows = [], 0
+    for batch in dataset.to_batches(columns=columns, filter=expression):
+        batches.append(batch)
+        num_rows += batch.num_rows
+        if num_rows >= batch_size:
+            yield pa.Table.from_batches(batches).to_pandas()
+            batches, num_rows = [], 0
+    if num_rows:
+        yield pa.Table.from_batches(batches).to_pandas()
+
+
+def _get_dataset_files(key: str) -> typing.List[str]:
+    """Returns the parquet files an output consists of: the files a dataset points at, or the output itself."""
+    if not key.endswith(DATASET_EXTENSION):
+        return [key]
+    return json.loads(get_backend().read_bytes(key))['files']
 
 
 def list_files(prefix: str = "") -> typing.List[str]:
@@ -175,32 +441,80 @@ def list_files(prefix: str = "") -> typing.List[str]:
         prefix (str): folder or directory to search, relative to the bucket name.
 
     Returns:
-        List[str]: list of strings corresponding to the immediate files in the directory specified.
+        List[str]: list of strings corresponding to the immediate files in the directory specified, relative to the bucket name.
     """
-    fs = s3fs.S3FileSystem(anon=True)
-    path = os.path.join(BUCKET_NAME, prefix)
-    return fs.ls(path)
+    return get_backend().ls(prefix)
 
 
-def load_output_df(component: str, dev: bool = True, version: str = None) -> pd.DataFrame:
+def load_output_df(component: str, dev: bool = True, version: str = None, columns: typing.List[str] = None, filters: typing.List[tuple] = None, sample_frac: float = None, random_state: int = 42) -> pd.DataFrame:
     """
-    This function loads the latest version of data that was produced by a component.
+    This function loads the latest version of data that was produced by a component. Column selection, filters and sampling
+    are pushed down to the parquet reader, so only the row groups and columns needed are read.
 
     Args:
         component (str): component name that we want to get the output from
         dev (bool): whether this is run in development or "production" mode
         version (str, optional): specified version of the data
+        columns (List[str], optional): columns to load. Defaults to all columns.
+        filters (List[tuple], optional): row filters in pyarrow format, i.e. [('tpep_pickup_datetime', '>=', pd.Timestamp('2020-12-01'))]
+        sample_frac (float, optional): if specified, load a random fraction of the row groups instead of the whole file
+        random_state (int, optional): seed for choosing row groups when sampling
 
     Returns:
         df (pd.DataFrame): dataframe corresponding to the data in the latest version of the output for the specified component
     """
 
     # Load data
-    filename = get_output_path(component, dev, version)
-    df = pd.read_parquet(filename)
+    key = _get_output_key(component, dev, version)
+    if key.endswith(DATASET_EXTENSION):
+        return _read_dataset(load_output_dataset(component, dev, version), columns, filters, sample_frac, random_state)
+    with get_backend().open(key, 'rb') as f:
+        if sample_frac is None:
+            df = pd.read_parquet(f, columns=columns, filters=filters)
+        else:
+            df = _read_sampled_row_groups(
+                f, columns, filters, sample_frac, random_state)
     return df
 
 
+def _read_dataset(dataset: ds.Dataset, columns: typing.List[str], filters: typing.List[tuple], sample_frac: float, random_state: int) -> pd.DataFrame:
+    """Same as _read_sampled_row_groups, but for an arrow dataset. Row groups are sampled across all of its files."""
+    expression = pq.filters_to_expression(filters) if filters else None
+    if sample_frac is None:
+        return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+    assert 0 < sample_frac <= 1, 'Sample fraction must be in (0, 1].'
+    row_groups = [row_group for fragment in dataset.get_fragments()
+                  for row_group in fragment.split_by_row_group()]
+    num_sampled = max(1, round(len(row_groups) * sample_frac))
+    sampled = random.Random(random_state).sample(range(len(row_groups)), num_sampled)
+    tables = [row_groups[i].to_table(schema=dataset.schema, columns=columns, filter=expression)
+              for i in sorted(sampled)]
+    return pa.concat_tables(tables).to_pandas()
+
+
+def _read_sampled_row_groups(f: typing.IO, columns: typing.List[str], filters: typing.List[tuple], sample_frac: float, random_state: int) -> pd.DataFrame:
+    """Reads a random sample_frac of a parquet file's row groups (at least one), then applies filters and selects columns."""
+    assert 0 < sample_frac <= 1, 'Sample fraction must be in (0, 1].'
+    parquet_file = pq.ParquetFile(f)
+    num_row_groups = parquet_file.num_row_groups
+    num_sampled = max(1, round(num_row_groups * sample_frac))
+    row_groups = sorted(random.Random(random_state).sample(
+        range(num_row_groups), num_sampled))
+
+    # Filter columns have to be read even if they aren't returned
+    read_columns = None
+    if columns is not None:
+        read_columns = list(dict.fromkeys(
+            columns + [filter[0] for filter in filters or []]))
+    table = parquet_file.read_row_groups(row_groups, columns=read_columns)
+    if filters:
+        table = table.filter(pq.filters_to_expression(filters))
+    if columns is not None:
+        table = table.select(columns)
+    return table.to_pandas()
+
+
 def load_output_pkl(component: str, dev: bool = True, version: str = None) -> object:
     """
     This function loads the latest version of an object that was produced by a component.
@@ -213,17 +527,44 @@ def load_output_pkl(component: str, dev: bool = True, version: str = None) -> ob
     Returns:
         object: object corresponding to the latest version of the output for the specified component
     """
-    filename = get_output_path(component, dev, version)
-
-    # Strip bucket name
-    filename = filename[len('s3://' + BUCKET_NAME) + 1:]
-    s3_client = boto3.client('s3')
-    obj = s3_client.get_object(Bucket=BUCKET_NAME, Key=filename)
-    serialized_obj = obj['Body'].read()
+    key = _get_output_key(component, dev, version)
+    serialized_obj = get_backend().read_bytes(key)
     deserialized_obj = pickle.loads(serialized_obj)
     return deserialized_obj
 
 
+def get_local_output_path(component: str, dev: bool = True, version: str = None) -> str:
+    """
+    This function gets a path on local disk for the latest or specified version of a component's output, i.e. to memory map it.
+    Outputs on a remote backend are downloaded once into OUTPUT_CACHE_DIR.
+
+    Args:
+        component (str): component name that we want to get the output from
+        dev (bool): whether this is run in development or "production" mode
+        version (str, optional): specified version of the data
+
+    Returns:
+        str: local path of the file
+    """
+    key = _get_output_key(component, dev, version)
+    return get_backend().local_path(key, OUTPUT_CACHE_DIR)
+
+
+def get_output_size(component: str, dev: bool = True, version: str = None) -> int:
+    """
+    This function gets the size in bytes of the latest or specified version of a component's output.
+
+    Args:
+        component (str): component name that we want to get the output from
+        dev (bool): whether this is run in development or "production" mode
+        version (str, optional): specified version of the data
+
+    Returns:
+        int: size of the file in bytes
+    """
+    return get_backend().size(_get_output_key(component, dev, version))
+
+
 def get_output_path(component: str, dev: bool = True, version: str = None) -> str:
     """
     This function gets the path corresponding to the latest or specified version of a component.
@@ -236,16 +577,114 @@ def get_output_path(component: str, dev: bool = True, version: str = None) -> st
     Returns:
         filename: filename corresponding the specified or latest version of the output for the specified component
     """
+    return get_backend().url(_get_output_key(component, dev, version))
 
-    assert len(component) > 0, 'Component name should not be empty.'
 
-    prefix = os.path.join(
-        'dev', component) if dev else os.path.join('prod', component)
+def load_manifest(component: str, dev: bool = True) -> dict:
+    """
+    This function loads the manifest of versions written to a component. Components written before manifests existed have an empty manifest.
+
+    Args:
+        component (str): component name
+        dev (bool): whether this is run in development or "production" mode
+
+    Returns:
+        dict: manifest with the key of the latest version under "latest" and an entry per file under "files"
+    """
+    return _read_manifest(_get_component_prefix(component, dev))
+
+
+def get_output_metadata(component: str, dev: bool = True, version: str = None) -> dict:
+    """
+    This function gets the metadata recorded when the latest or specified version of a component's output was saved.
+
+    Args:
+        component (str): component name that we want to get the output from
+        dev (bool): whether this is run in development or "production" mode
+        version (str, optional): specified version of the data
+
+    Returns:
+        dict: metadata passed to save_output_*, or an empty dictionary if none was recorded
+    """
+    key = _get_output_key(component, dev, version)
+    entry = load_manifest(component, dev).get('files', {}).get(os.path.basename(key), {})
+    return entry.get('metadata', {})
+
+
+def _get_output_key(component: str, dev: bool = True, version: str = None) -> str:
+    """Same as get_output_path, but returns the key relative to the storage root."""
+    prefix = _get_component_prefix(component, dev)
 
     if version is not None:
+        matches = [entry['path'] for filename, entry in _read_manifest(prefix).get('files', {}).items()
+                   if filename.split('.')[0] == version]
+        if not matches:
+            # Versions saved before the component had a manifest. Directories (i.e. clean/2020_01) are not versions.
+            matches = [key for key in get_backend().ls(prefix, files_only=True)
+                       if os.path.basename(key).split('.')[0] == version]
+        if matches:
+            return max(matches)
+        # Otherwise the version names a subdirectory (i.e. version 2020_01 of clean), whose latest output is returned
         prefix = os.path.join(prefix, version)
 
+    manifest = _read_manifest(prefix)
+    if manifest.get('latest'):
+        return manifest['latest']
+    # Fall back to listing for components without a manifest
     filenames = list_files(prefix)
-    filename = get_file_at_latest_timestamp(filenames)
+    return get_file_at_latest_timestamp(filenames)
 
-    return f's3://{filename}'
+
+def _get_component_prefix(component: str, dev: bool = True) -> str:
+    """Returns the directory that holds a component's outputs, relative to the storage root."""
+    assert len(component) > 0, 'Component name should not be empty.'
+
+    return os.path.join('dev', component) if dev else os.path.join('prod', component)
+
+
+def _read_manifest(prefix: str, use_cache: bool = True) -> dict:
+    """Reads a component's manifest, serving it from the in-process cache if it was read less than MANIFEST_CACHE_TTL seconds ago."""
+    backend = get_backend()
+    cache_key = (backend.root, prefix)
+    now = time.monotonic()
+
+    with _manifest_cache_lock:
+        cached = _manifest_cache.get(cache_key)
+    if use_cache and cached and cached[0] > now:
+        return cached[1]
+
+    try:
+        manifest = json.loads(backend.read_bytes(
+            os.path.join(prefix, MANIFEST_FILENAME)))
+    except FileNotFoundError:
+        manifest = {}
+
+    with _manifest_cache_lock:
+        _manifest_cache[cache_key] = (now + MANIFEST_CACHE_TTL, manifest)
+    return manifest
+
+
+def _update_manifest(prefix: str, key: str, metadata: dict = None):
+    """
+    Records a newly written file in its component's manifest. The manifest is rewritten in a single put, so readers
+    never see a partial manifest. Concurrent writers to the same component are not supported.
+    """
+    manifest = _read_manifest(prefix, use_cache=False)
+    files = manifest.setdefault('files', {})
+    files[os.path.basename(key)] = {
+        'path': key, 'created': get_timestamp_as_string(), 'metadata': metadata or {}}
+
+    # Same rule as get_file_at_latest_timestamp: only timestamp-formatted versions can be the latest
+    candidates = [path for path in [manifest.get('latest'), key] if path]
+    try:
+        manifest['latest'] = get_file_at_latest_timestamp(candidates)
+    except ValueError:
+        pass
+
+    backend = get_backend()
+    backend.write_bytes(os.path.join(prefix, MANIFEST_FILENAME),
+                        json.dumps(manifest, indent=2, sort_keys=True).encode())
+
+    with _manifest_cache_lock:
+        _manifest_cache[(backend.root, prefix)] = (
+            time.monotonic() + MANIFEST_CACHE_TTL, manifest)
@@ -7,6 +7,8 @@ This file contains the abstraction for a model, which should include:
 - metrics (or pointer to metrics)
 """
 from abc import ABC, abstractmethod
+from . import artifact
+from .forest import CompiledForest, MAX_COMPILED_ROWS
 from .helpers import assert_subset
 from .io import *
 from sklearn.ensemble import RandomForestClassifier
@@ -14,11 +16,13 @@ from sklearn.metrics import f1_score
 
 import numpy as np
 import pandas as pd
+import threading
 import typing
 
 RANDOM_STATE = 42
 ALL_PROCESSORS = -1
 IMPUTATION_VALUE = -1.0
+ARTIFACT_EXTENSION = '.model'
 
 
 class ModelWrapper(ABC):
@@ -27,12 +31,29 @@ class ModelWrapper(ABC):
     def __init__(self, name: str, feature_columns: typing.List[str] = [], model_params: dict = {}, data_dict: dict = {}, metric_dict: dict = {}):
         """Constructor. data_dict and metric_dict store dictionaries of data paths and metric values respectively."""
         self.name = name
-        self.feature_columns = feature_columns
-        self.model_params = model_params
-        self.data_dict = data_dict
-        self.metric_dict = metric_dict
+        # Copied so that wrappers never share (and mutate) the default arguments
+        self.feature_columns = list(feature_columns)
+        self.model_params = dict(model_params)
+        self.data_dict = dict(data_dict)
+        self.metric_dict = dict(metric_dict)
         self.model = None
 
+    def __getstate__(self) -> dict:
+        """Per-thread preprocessing buffers are scratch space, so they aren't pickled."""
+        state = self.__dict__.copy()
+        state.pop('_buffers', None)
+        return state
+
+    def _get_buffer(self, num_rows: int) -> np.ndarray:
+        """Returns a C-contiguous float32 (num_rows, num_features) array, reusing this thread's buffer if it is big enough."""
+        buffers = self.__dict__.setdefault('_buffers', threading.local())
+        buffer = getattr(buffers, 'buffer', None)
+        if buffer is None or buffer.shape[0] < num_rows or buffer.shape[1] != len(self.feature_columns):
+            buffer = np.empty(
+                (num_rows, len(self.feature_columns)), dtype=np.float32)
+            buffers.buffer = buffer
+        return buffer[:num_rows]
+
     def add_feature_columns(self, feature_columns: typing.List[str]):
         """Adds a list of feature columns to the current list. No deduping."""
         self.feature_columns += feature_columns
@@ -75,6 +96,23 @@ class ModelWrapper(ABC):
         """Loads a model wrapper object from s3."""
         return load_output_pkl(component, dev, version)
 
+    def score_streaming(self, chunks: typing.Iterable[pd.DataFrame], label_column: str) -> float:
+        """Returns F1 score over dataframes that are scored one at a time, i.e. from io.iter_output_df."""
+        true_positives, false_positives, false_negatives = 0, 0, 0
+        for chunk in chunks:
+            labels = chunk[label_column].to_numpy().astype(bool)
+            preds = self.predict(chunk).round().astype(bool)
+            true_positives += int((preds & labels).sum())
+            false_positives += int((preds & ~labels).sum())
+            false_negatives += int((~preds & labels).sum())
+
+        denominator = 2 * true_positives + false_positives + false_negatives
+        return 2 * true_positives / denominator if denominator else 0.0
+
+    def predict_records(self, records: typing.List[dict]) -> np.ndarray:
+        """Predicts on records (i.e. parsed JSON requests) mapping feature names to values. Subclasses can skip building a dataframe."""
+        return self.predict(pd.DataFrame.from_records(records, columns=self.feature_columns))
+
     @abstractmethod
     def preprocess(self):
         pass
@@ -99,11 +137,27 @@ class RandomForestModelWrapper(ModelWrapper):
         base_params.update(model_params)
         super(RandomForestModelWrapper, self).__init__(
             name='random_forest_classifier_no_preprocessing', feature_columns=feature_columns, model_params=base_params)
+        self.compiled_model = None
 
     def preprocess(self, df: pd.DataFrame) -> np.ndarray:
-        """Identity map for preprocessing but fill null values with -1"""
+        """
+        Identity map for preprocessing but fill null values with -1. Columns are written straight into a reused float32 buffer
+        (the dtype the forest uses internally), so the returned array is only valid until the next call on the same thread.
+        """
         assert_subset(self.feature_columns, df.columns)
-        return df[self.feature_columns].fillna(IMPUTATION_VALUE).values
+        X = self._get_buffer(len(df))
+        for i, col in enumerate(self.feature_columns):
+            values = df[col]
+            if isinstance(values.dtype, np.dtype):
+                np.copyto(X[:, i], values.to_numpy(), casting='unsafe')
+                # Only bool and integer columns can't hold missing values (object columns' None becomes NaN)
+                if values.dtype.kind not in 'biu':
+                    X[np.isnan(X[:, i]), i] = IMPUTATION_VALUE
+            else:
+                # Nullable and categorical columns have no numpy view of their values
+                X[:, i] = values.to_numpy(
+                    dtype=np.float32, na_value=IMPUTATION_VALUE)
+        return X
 
     def train(self, df: pd.DataFrame, label_column: str):
         """Fits a random forest classifier to the data."""
@@ -116,11 +170,109 @@ class RandomForestModelWrapper(ModelWrapper):
         model = RandomForestClassifier(**self.model_params)
         model.fit(X, y)
         self.model = model
+        self.compiled_model = None
+
+    def train_streaming(self, chunks: typing.Iterable[pd.DataFrame], label_column: str, trees_per_chunk: int = 10):
+        """
+        Fits a random forest one dataframe at a time, i.e. from io.iter_output_df, so memory is bounded by the chunk size.
+        Each chunk fits a sub-forest of trees_per_chunk trees, and the sub-forests are merged into one forest (bagging over chunks).
+        """
+        assert label_column not in self.feature_columns, 'Label column is in the feature list.'
+
+        model = None
+        random_state = self.model_params.get('random_state')
+        for i, chunk in enumerate(chunks):
+            assert label_column in chunk.columns, 'Label column is not in the dataframe.'
+            params = dict(self.model_params, n_estimators=trees_per_chunk,
+                          random_state=None if random_state is None else random_state + i)
+            sub_model = RandomForestClassifier(**params)
+            sub_model.fit(self.preprocess(chunk), chunk[label_column].values)
+
+            if model is None:
+                model = sub_model
+                continue
+            assert np.array_equal(
+                model.classes_, sub_model.classes_), 'Every chunk must contain the same classes.'
+            model.estimators_ += sub_model.estimators_
+            model.n_estimators = len(model.estimators_)
+
+        assert model is not None, 'No chunks to train on.'
+        self.model = model
+        self.compiled_model = None
+
+    def compile(self):
+        """Flattens the trained forest into a CompiledForest, which predict then uses for low-latency scoring of small dataframes."""
+        assert self.model is not None, 'Model is not trained. Please call .train(...).'
+        self.compiled_model = CompiledForest.from_sklearn(self.model)
+
+    def save_artifact(self, component: str, dev: bool = True, overwrite: bool = False, version: str = None) -> str:
+        """
+        Saves the compiled forest and the wrapper's metadata as a model artifact (see artifact.py), which load_artifact memory maps
+        instead of unpickling. Compiles the model if it isn't already.
+        """
+        assert self.data_dict, 'No data paths were added.'
+        assert self.metric_dict, 'No metrics were added.'
+        if getattr(self, 'compiled_model', None) is None:
+            self.compile()
+
+        metadata = {'name': self.name, 'feature_columns': self.feature_columns, 'model_params': self.model_params,
+                    'data_dict': self.data_dict, 'metric_dict': self.metric_dict, 'max_depth': self.compiled_model.max_depth}
+        return save_output_bytes(artifact.dumps(metadata, self.compiled_model.arrays()), ARTIFACT_EXTENSION, component, dev, overwrite, version)
+
+    @classmethod
+    def load_artifact(cls, component: str, dev: bool = True, version: str = None):
+        """
+        Loads a model wrapper from a model artifact. The forest's arrays are memory mapped, so processes that load the same version
+        share one copy. Only the compiled forest is loaded, so the wrapper can predict but has no sklearn model to inspect.
+        """
+        metadata, arrays = artifact.load(
+            get_local_output_path(component, dev, version))
+        mw = cls(feature_columns=metadata['feature_columns'],
+                 model_params=metadata['model_params'])
+        mw.add_data_paths(metadata['data_dict'])
+        mw.add_metrics(metadata['metric_dict'])
+        mw.compiled_model = CompiledForest(
+            max_depth=metadata['max_depth'], **arrays)
+        return mw
+
+    def records_to_matrix(self, records: typing.List[dict]) -> np.ndarray:
+        """
+        The same as preprocess, but for records (i.e. parsed JSON requests) instead of a dataframe. Values are copied straight into
+        the thread's float32 buffer in feature_columns order, and missing, null and NaN values become IMPUTATION_VALUE.
+        Raises ValueError if a value isn't a number.
+        """
+        X = self._get_buffer(len(records))
+        values = [IMPUTATION_VALUE if value is None else value
+                  for record in records for value in map(record.get, self.feature_columns)]
+        try:
+            X.reshape(-1)[:] = values
+        except (TypeError, ValueError):
+            for record in records:
+                for col in self.feature_columns:
+                    try:
+                        float(record.get(col) or 0)
+                    except (TypeError, ValueError):
+                        raise ValueError(
+                            f'Feature {col} must be a number or null.')
+            raise
+        X[np.isnan(X)] = IMPUTATION_VALUE
+        return X
 
     def predict(self, df: pd.DataFrame) -> np.ndarray:
         """Returns probability of the prediction being of class 1."""
-        assert self.model is not None, 'Model is not trained. Please call .train(...).'
-        X = self.preprocess(df)
+        return self.predict_matrix(self.preprocess(df))
+
+    def predict_records(self, records: typing.List[dict]) -> np.ndarray:
+        """Returns probability of class 1 for each record, without building a dataframe (see records_to_matrix)."""
+        return self.predict_matrix(self.records_to_matrix(records))
+
+    def predict_matrix(self, X: np.ndarray) -> np.ndarray:
+        """Returns probability of class 1 for each row of already preprocessed features (i.e. from preprocess or records_to_matrix)."""
+        # Models saved before compile existed don't have the attribute
+        compiled_model = getattr(self, 'compiled_model', None)
+        assert self.model is not None or compiled_model is not None, 'Model is not trained. Please call .train(...).'
+        if compiled_model is not None and (self.model is None or len(X) <= MAX_COMPILED_ROWS):
+            return compiled_model.predict_proba(X)
         return self.model.predict_proba(X)[:, 1]
 
     def score(self, df: pd.DataFrame, label_column: str) -> float:
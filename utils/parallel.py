@@ -0,0 +1,119 @@
+"""
+parallel.py
+
+This file contains a helper to run a pipeline component's independent months in a pool of processes. Configured by:
+- NUM_WORKERS: maximum number of months processed at once (defaults to the number of cpus)
+- MAX_MEMORY_GB: memory budget shared by the months in flight (defaults to 75% of physical memory)
+"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import os
+import traceback
+import typing
+
+
+def get_total_memory() -> int:
+    """Returns the physical memory of the machine in bytes."""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+NUM_WORKERS = int(os.environ.get('NUM_WORKERS', os.cpu_count() or 1))
+MEMORY_BUDGET = int(float(os.environ.get(
+    'MAX_MEMORY_GB', 0.75 * get_total_memory() / 1e9)) * 1e9)
+
+
+def run_months(fn: typing.Callable[[str, str], typing.Any], month_years: typing.Iterable[typing.Tuple[str, str]], estimate_memory: typing.Callable[[str, str], int] = None, max_workers: int = NUM_WORKERS, memory_budget: int = MEMORY_BUDGET) -> dict:
+    """
+    This function runs fn(month, year) for every month in a process pool and prints each result as it finishes.
+    A month is only started if its estimated memory fits in the budget next to the months already running (a month
+    that doesn't fit on its own runs alone). A failed month is reported without stopping the others. That includes a month whose
+    estimate fails and a month whose worker is killed (i.e. out of memory), which fails every month in flight with it; the
+    pending months then run in a new pool.
+
+    Args:
+        fn (Callable): top-level function that processes one month, i.e. fn('05', '2020')
+        month_years (Iterable[Tuple[str, str]]): (month, year) pairs to process
+        estimate_memory (Callable, optional): returns the estimated peak bytes of fn(month, year). Defaults to no memory limit.
+        max_workers (int, optional): maximum number of months processed at once
+        memory_budget (int, optional): maximum total estimated bytes of the months processed at once
+
+    Returns:
+        dict: maps (month, year) to the return value of fn
+
+    Raises:
+        RuntimeError: after all months finish, if any of them failed
+    """
+    results, failures = {}, {}
+
+    def fail(month_year):
+        month, year = month_year
+        failures[month_year] = traceback.format_exc()
+        print(f'{year}_{month} failed:\n{failures[month_year]}')
+
+    def record(month_year, get_result):
+        month, year = month_year
+        try:
+            results[month_year] = get_result()
+            print(f'{year}_{month}: {results[month_year]}')
+        except Exception:
+            fail(month_year)
+
+    pending = []
+    for month_year in month_years:
+        try:
+            pending.append((month_year, estimate_memory(
+                *month_year) if estimate_memory else 0))
+        except Exception:
+            # i.e. the month's input doesn't exist
+            fail(month_year)
+
+    if max_workers <= 1:
+        for month_year, _ in pending:
+            record(month_year, lambda: fn(*month_year))
+    else:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+        running = {}
+        try:
+            while pending or running:
+                broken = False
+                # Admit the first pending months that fit in the memory left
+                in_use = sum(running.values())
+                for item in list(pending):
+                    month_year, estimate = item
+                    if len(running) >= max_workers:
+                        break
+                    if running and in_use + estimate > memory_budget:
+                        continue
+                    try:
+                        future = executor.submit(fn, *month_year)
+                    except BrokenProcessPool:
+                        # A running month's worker died since the last wait
+                        broken = True
+                        break
+                    running[(future, month_year)] = estimate
+                    in_use += estimate
+                    pending.remove(item)
+
+                done, _ = wait([future for future, _ in running],
+                               return_when=FIRST_COMPLETED)
+                broken = broken or any(isinstance(
+                    future.exception(), BrokenProcessPool) for future in done)
+                if broken:
+                    # A killed worker (i.e. out of memory) fails every month in flight, so wait for all of them to be marked failed
+                    done, _ = wait([future for future, _ in running])
+                for future, month_year in list(running):
+                    if future in done:
+                        del running[(future, month_year)]
+                        record(month_year, future.result)
+                if broken:
+                    # Pending months go to a new pool
+                    executor.shutdown()
+                    executor = ProcessPoolExecutor(max_workers=max_workers)
+        finally:
+            executor.shutdown()
+
+    if failures:
+        failed = ', '.join(f'{year}_{month}' for month, year in failures)
+        raise RuntimeError(f'{len(failures)} month(s) failed: {failed}')
+    return results
@@ -0,0 +1,146 @@
+"""
+search.py
+
+This file contains a hyperparameter search driver for RandomForestModelWrapper's model_params, supporting:
+- grid search (grid_candidates)
+- random search (random_candidates)
+- successive halving over either list of candidates
+
+Trials are cross-validated in a pool of processes. The training matrix is preprocessed once and written to a memory-mapped
+file that every trial reads, instead of being pickled to each worker. The rows are written twice in a row, so each fold's
+training rows are one contiguous slice of the map, and workers never copy them.
+"""
+from .models import RANDOM_STATE, RandomForestModelWrapper
+from .parallel import NUM_WORKERS
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import f1_score
+
+import itertools
+import math
+import numpy as np
+import os
+import pandas as pd
+import random
+import tempfile
+import typing
+
+# Rows copied at a time when writing the shuffled matrix to disk
+WRITE_CHUNKSIZE = 1_000_000
+
+
+def grid_candidates(param_grid: dict) -> typing.List[dict]:
+    """Returns every combination of the values in param_grid, i.e. {'max_depth': [5, 10], 'n_estimators': [50, 100]}."""
+    keys = list(param_grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*param_grid.values())]
+
+
+def random_candidates(param_distributions: dict, n_iter: int, random_state: int = RANDOM_STATE) -> typing.List[dict]:
+    """Returns n_iter random combinations. Each value in param_distributions is a list to choose from or a function of a random.Random."""
+    rng = random.Random(random_state)
+    return [{key: values(rng) if callable(values) else rng.choice(values) for key, values in param_distributions.items()}
+            for _ in range(n_iter)]
+
+
+def search(mw: RandomForestModelWrapper, df: pd.DataFrame, label_column: str, candidates: typing.List[dict], n_folds: int = 3, halving_factor: int = None, min_samples: int = None, max_workers: int = NUM_WORKERS, tmp_dir: str = None) -> typing.List[dict]:
+    """
+    This function cross-validates candidate model_params for a model wrapper and records the results in it. The best candidate's
+    params are merged into mw.model_params (the model itself is not trained), and the results are added as the "cv_f1" and "search_results" metrics.
+
+    Args:
+        mw (RandomForestModelWrapper): wrapper whose feature columns and model params the candidates are applied on top of
+        df (pd.DataFrame): training data
+        label_column (str): name of the label column
+        candidates (List[dict]): model params to try, i.e. from grid_candidates or random_candidates
+        n_folds (int, optional): number of cross-validation folds
+        halving_factor (int, optional): if specified, run successive halving: start on min_samples rows and keep the best 1 / halving_factor of the candidates each round, multiplying the rows by halving_factor
+        min_samples (int, optional): rows used in the first round of successive halving. Defaults to the rows needed to reach all rows in the last round.
+        max_workers (int, optional): number of trials run at once
+        tmp_dir (str, optional): directory for the memory-mapped training matrix (i.e. /dev/shm). Defaults to the system temporary directory.
+
+    Returns:
+        List[dict]: one result per trial with its "params", "n_samples" and mean validation "f1", best first
+    """
+    assert candidates, 'No candidates to search.'
+    assert label_column in df.columns, 'Label column is not in the dataframe.'
+    base_params = dict(mw.model_params)
+    # Trials run in parallel, so each forest uses one core unless specified
+    if max_workers > 1 and 'n_jobs' not in candidates[0]:
+        base_params['n_jobs'] = 1
+
+    X = mw.preprocess(df)
+    y = df[label_column].to_numpy()
+    permutation = np.random.RandomState(RANDOM_STATE).permutation(len(df))
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as directory:
+        num_rows = len(df)
+
+        if halving_factor is None:
+            rounds = [num_rows]
+        else:
+            assert halving_factor >= 2, 'Halving factor must be at least 2.'
+            num_rounds = max(1, math.ceil(
+                math.log(len(candidates), halving_factor)) + 1)
+            first = min_samples or num_rows // halving_factor ** (num_rounds - 1)
+            rounds = [min(num_rows, max(first, n_folds) * halving_factor ** i)
+                      for i in range(num_rounds)]
+
+        results = []
+        remaining = candidates
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for n_samples in rounds:
+                # Each round uses the first n_samples shuffled rows
+                X_path, y_path = _write_shared_matrix(
+                    X, y, permutation[:n_samples], directory)
+                trials = [dict(base_params, **params) for params in remaining]
+                scores = list(executor.map(_run_trial, trials, itertools.repeat(X_path),
+                                           itertools.repeat(y_path), itertools.repeat(n_folds)))
+                os.remove(X_path)
+                os.remove(y_path)
+                round_results = sorted([{'params': params, 'n_samples': n_samples, 'f1': score}
+                                        for params, score in zip(remaining, scores)], key=lambda result: -result['f1'])
+                results = round_results + results
+                if halving_factor is None or len(remaining) == 1:
+                    break
+                remaining = [result['params'] for result in round_results[:max(
+                    1, len(remaining) // halving_factor)]]
+
+    best = results[0]
+    mw.model_params.update(best['params'])
+    mw.add_metric('cv_f1', best['f1'])
+    mw.add_metric('search_results', results)
+    return results
+
+
+def _write_shared_matrix(X: np.ndarray, y: np.ndarray, rows: np.ndarray, directory: str) -> typing.Tuple[str, str]:
+    """
+    Writes the features and labels of rows, in that order and then again, to .npy files that trials memory map. With n rows, the
+    held-out rows of a fold are rows [start, end) and its training rows are rows [end, start + n), so both are contiguous slices.
+    """
+    X_path, y_path = os.path.join(
+        directory, f'X_{len(rows)}.npy'), os.path.join(directory, f'y_{len(rows)}.npy')
+    X_shared = np.lib.format.open_memmap(
+        X_path, mode='w+', dtype=X.dtype, shape=(2 * len(rows), X.shape[1]))
+    for offset in [0, len(rows)]:
+        for start in range(0, len(rows), WRITE_CHUNKSIZE):
+            chunk = rows[start:start + WRITE_CHUNKSIZE]
+            X_shared[offset + start:offset + start + len(chunk)] = X[chunk]
+    X_shared.flush()
+    np.save(y_path, np.concatenate([y[rows], y[rows]]))
+    return X_path, y_path
+
+
+def _run_trial(params: dict, X_path: str, y_path: str, n_folds: int) -> float:
+    """Returns the mean validation F1 of a random forest with params over n_folds folds of the rows in a matrix from _write_shared_matrix."""
+    X = np.load(X_path, mmap_mode='r')
+    y = np.load(y_path, mmap_mode='r')
+    n_samples = len(X) // 2
+
+    scores = []
+    fold_bounds = np.linspace(0, n_samples, n_folds + 1).astype(int)
+    for start, end in zip(fold_bounds[:-1], fold_bounds[1:]):
+        # The training rows wrap around the held-out rows, so held-out rows are never drawn in bootstraps or count towards min_samples_leaf
+        model = RandomForestClassifier(**params)
+        model.fit(X[end:start + n_samples], y[end:start + n_samples])
+        scores.append(f1_score(y[start:end], model.predict(X[start:end])))
+    return float(np.mean(scores))
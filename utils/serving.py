@@ -0,0 +1,234 @@
+"""
+serving.py
+
+This file contains helpers for serving a model behind the inference API.
+
+MicroBatcher collects single-row requests that arrive at about the same time and scores them in one call, so concurrent
+requests share one vectorized predict instead of each running its own.
+
+ModelReloader holds the served model, and swaps in new versions from a background thread once they are loaded and warmed up.
+
+PredictionCache remembers recent predictions by feature vector and model version, so repeated requests skip the model.
+"""
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+import os
+import queue
+import threading
+import time
+import traceback
+import typing
+
+MAX_BATCH_SIZE = int(os.environ.get('PREDICT_MAX_BATCH_SIZE', 64))
+# Longest time the first request of a batch waits for others to join it
+MAX_WAIT_MS = float(os.environ.get('PREDICT_MAX_WAIT_MS', 1))
+# Seconds between checks for a new model version. 0 turns reloading off.
+RELOAD_INTERVAL = float(os.environ.get('MODEL_RELOAD_INTERVAL', 60))
+# Predictions kept per process. 0 turns caching off.
+CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 0))
+# Seconds a cached prediction is used for
+CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL', 300))
+
+
+class MicroBatcher(object):
+    """
+    Scores records in batches on a background thread. A batch starts with the first waiting record and takes every record that
+    arrives within max_wait seconds, up to max_batch_size. With max_wait=0, a batch is whatever queued up while the previous one was scored.
+    """
+
+    def __init__(self, predict_fn: typing.Callable[[typing.List[dict]], typing.Sequence], max_batch_size: int = MAX_BATCH_SIZE, max_wait: float = MAX_WAIT_MS / 1000):
+        """Constructor. predict_fn takes a list of records and returns one prediction per record, in order."""
+        assert max_batch_size >= 1, 'Batches must hold at least one record.'
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _ensure_started(self):
+        """Starts the scoring thread on first use, and again in forked children, which don't inherit threads."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(
+                    target=self._run, args=(self._queue,), daemon=True)
+                self._thread.start()
+
+    def submit(self, record: dict) -> Future:
+        """Queues a record and returns a future for its prediction."""
+        if self._pid != os.getpid():
+            self._ensure_started()
+        future = Future()
+        self._queue.put((record, future))
+        return future
+
+    def predict(self, record: dict, timeout: float = None) -> typing.Any:
+        """Returns the prediction for a record, raising the error predict_fn raised for it if any."""
+        return self.submit(record).result(timeout)
+
+    def _run(self, requests: queue.Queue):
+        while True:
+            batch = [requests.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                # After the deadline, still take whatever is already waiting
+                timeout = deadline - time.monotonic()
+                try:
+                    batch.append(requests.get(timeout=timeout)
+                                 if timeout > 0 else requests.get_nowait())
+                except queue.Empty:
+                    break
+            self._score(batch)
+
+    def _score(self, batch: typing.List[tuple]):
+        records = [record for record, _ in batch]
+        try:
+            preds = self.predict_fn(records)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Score records one at a time so that a bad record only fails its own request
+            for item in batch:
+                self._score([item])
+            return
+        for (_, future), pred in zip(batch, preds):
+            future.set_result(pred)
+
+
+class ModelReloader(object):
+    """
+    Holds the served model and its version. load swaps in a version only after it is loaded and warmed up, so requests always
+    see a ready model, and requests already using the previous model finish with it.
+    """
+
+    def __init__(self, load_fn: typing.Callable[[str], typing.Any], latest_version_fn: typing.Callable[[], str], warm_up_fn: typing.Callable[[typing.Any], None] = None, poll_interval: float = RELOAD_INTERVAL, on_load: typing.Callable[[typing.Any, str], None] = None):
+        """
+        Constructor.
+
+        Args:
+            load_fn (Callable[[str], Any]): loads the model for a version
+            latest_version_fn (Callable[[], str]): returns the latest version
+            warm_up_fn (Callable[[Any], None], optional): runs a prediction on a newly loaded model. Raising marks the version as bad.
+            poll_interval (float, optional): seconds between checks for a new version
+            on_load (Callable[[Any, str], None], optional): called with the model and version after a new version is swapped in, i.e. to clear caches
+        """
+        self.load_fn = load_fn
+        self.latest_version_fn = latest_version_fn
+        self.warm_up_fn = warm_up_fn
+        self.poll_interval = poll_interval
+        self.on_load = on_load
+        # (model, version), replaced as a whole so readers never see a model with another version's number
+        self.current = (None, None)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self) -> bool:
+        """Whether a model has been loaded and warmed up."""
+        return self.current[0] is not None
+
+    def load(self, version: str = None) -> bool:
+        """Loads and warms up a version (defaults to the latest) and serves it. Returns whether the served version changed."""
+        with self._lock:
+            version = version or self.latest_version_fn()
+            if version == self.current[1]:
+                return False
+            model = self.load_fn(version)
+            if self.warm_up_fn is not None:
+                self.warm_up_fn(model)
+            self.current = (model, version)
+            if self.on_load is not None:
+                self.on_load(model, version)
+            return True
+
+    def start(self):
+        """Loads the latest version and then checks for new ones every poll_interval seconds on a background thread."""
+        self.load()
+        if self.poll_interval > 0 and self._thread is None:
+            self._thread = threading.Thread(target=self._poll, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _poll(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                if self.load():
+                    print(f'Serving model version {self.current[1]}.')
+            except Exception:
+                # Keep serving the current version
+                traceback.print_exc()
+
+
+class PredictionCache(object):
+    """
+    Bounded LRU cache of predictions with a time to live. Keys are the model version and the bytes of the preprocessed float32
+    feature vector, so requests that only differ in how values are written (i.e. 1 and 1.0, or null and a missing field) share an entry.
+    """
+
+    def __init__(self, max_size: int = CACHE_SIZE, ttl: float = CACHE_TTL):
+        """Constructor. A max_size of 0 turns the cache off."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: typing.Hashable) -> typing.Any:
+        """Returns the value for key, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: typing.Hashable, value: typing.Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Returns the size and hit/miss counters, i.e. to tune max_size."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def predict(self, X: np.ndarray, version: str, predict_fn: typing.Callable[[np.ndarray], np.ndarray]) -> np.ndarray:
+        """Returns predict_fn(X) for a matrix of preprocessed features, only scoring the rows that aren't cached."""
+        if self.max_size <= 0:
+            return predict_fn(X)
+        keys = [(version, row.tobytes()) for row in X]
+        preds = np.empty(len(X))
+        missing = []
+        for i, key in enumerate(keys):
+            pred = self.get(key)
+            if pred is None:
+                missing.append(i)
+            else:
+                preds[i] = pred
+        if missing:
+            preds[missing] = predict_fn(X[missing])
+            for i in missing:
+                self.put(keys[i], preds[i])
+        return preds
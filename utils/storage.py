@@ -0,0 +1,280 @@
+"""
+storage.py
+
+This file contains the abstraction for a storage backend, which the functions in io.py use to read and write pipeline files. A backend should include:
+- a root that keys (paths relative to the bucket) are resolved against
+- methods to list, check, open, read and write keys
+
+The backend is chosen by the STORAGE_BACKEND environment variable ("s3" or "local").
+
+S3 clients and filesystem handles are created once per process and shared between threads, so repeated calls
+reuse the same connection pool instead of paying for client setup and TLS handshakes every time.
+"""
+
+from abc import ABC, abstractmethod
+from botocore.config import Config
+from pyarrow import fs as arrow_fs
+
+import boto3
+import os
+import s3fs
+import tempfile
+import threading
+import typing
+
+BUCKET_NAME = 'toy-applied-ml-pipeline'
+DEFAULT_LOCAL_ROOT = os.path.join(os.path.expanduser('~'), BUCKET_NAME)
+MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', 32))
+
+_backend = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_s3_client(endpoint_url: str = None):
+    """
+    This function returns the process-wide boto3 S3 client for an endpoint, creating it on first use.
+
+    Args:
+        endpoint_url (str, optional): S3-compatible endpoint. Defaults to AWS.
+
+    Returns:
+        botocore client for S3 with a pool of up to MAX_POOL_CONNECTIONS connections
+    """
+    key = ('client', endpoint_url)
+    with _clients_lock:
+        if key not in _clients:
+            # Sessions are not thread safe, so each client gets its own
+            session = boto3.session.Session()
+            _clients[key] = session.client(
+                's3', endpoint_url=endpoint_url, config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+        return _clients[key]
+
+
+def get_s3_filesystem(anon: bool = False, endpoint_url: str = None) -> s3fs.S3FileSystem:
+    """
+    This function returns the process-wide s3fs filesystem for an endpoint, creating it on first use.
+
+    Args:
+        anon (bool, optional): whether to connect without credentials
+        endpoint_url (str, optional): S3-compatible endpoint. Defaults to AWS.
+
+    Returns:
+        s3fs.S3FileSystem: filesystem handle with a pool of up to MAX_POOL_CONNECTIONS connections
+    """
+    key = ('filesystem', anon, endpoint_url)
+    with _clients_lock:
+        if key not in _clients:
+            client_kwargs = {'endpoint_url': endpoint_url} if endpoint_url else {}
+            # Listings are not cached so that new versions written by other processes are visible
+            _clients[key] = s3fs.S3FileSystem(
+                anon=anon, client_kwargs=client_kwargs, config_kwargs={'max_pool_connections': MAX_POOL_CONNECTIONS},
+                use_listings_cache=False, skip_instance_cache=True)
+        return _clients[key]
+
+
+def reset_clients():
+    """Drops all pooled clients. Called in forked children, since connections can't be shared across processes."""
+    global _clients_lock
+    _clients.clear()
+    _clients_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_clients)
+
+
+class StorageBackend(ABC):
+    """Abstract class for a storage backend. Keys are paths relative to the root, i.e. dev/clean/2020_01/20210101-000000.pq"""
+
+    def __init__(self, root: str):
+        """Constructor stores the root (ex: s3://bucket or /path/to/dir) that keys are resolved against."""
+        self.root = root
+
+    def url(self, key: str) -> str:
+        """Returns the full path that a key can be accessed at."""
+        return os.path.join(self.root, key)
+
+    def key(self, url: str) -> str:
+        """Inverse of url: strips the root from a full path."""
+        assert url.startswith(self.root), f'{url} is not under {self.root}.'
+        return url[len(self.root):].lstrip('/')
+
+    @abstractmethod
+    def ls(self, prefix: str = '', files_only: bool = False) -> typing.List[str]:
+        """Returns keys of the immediate files (and directories, unless files_only) in prefix, [prefix] if it is a file and [] if it doesn't exist."""
+        pass
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        pass
+
+    @abstractmethod
+    def size(self, key: str) -> int:
+        pass
+
+    @abstractmethod
+    def open(self, key: str, mode: str = 'rb') -> typing.IO:
+        pass
+
+    @abstractmethod
+    def arrow_filesystem(self) -> arrow_fs.FileSystem:
+        """Returns a pyarrow filesystem for reading keys as arrow datasets, along with arrow_path."""
+        pass
+
+    @abstractmethod
+    def arrow_path(self, key: str) -> str:
+        pass
+
+    def read_bytes(self, key: str) -> bytes:
+        """Raises FileNotFoundError if the key doesn't exist."""
+        with self.open(key, 'rb') as f:
+            return f.read()
+
+    def write_bytes(self, key: str, data: bytes):
+        with self.open(key, 'wb') as f:
+            f.write(data)
+
+    def local_path(self, key: str, cache_dir: str) -> str:
+        """
+        Returns a path on local disk with the contents of a key (i.e. to memory map it), downloading it into cache_dir on first use.
+        Keys are versioned outputs that never change, so a cached copy is never stale.
+        """
+        path = os.path.join(cache_dir, key)
+        if not os.path.exists(path):
+            data = self.read_bytes(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Other processes may download the same key at once, so each writes its own file and renames it into place
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return path
+
+
+class S3Backend(StorageBackend):
+    def __init__(self, bucket: str = BUCKET_NAME, endpoint_url: str = None):
+        """Endpoint url can point at a local S3 stand-in (i.e. minio)."""
+        super(S3Backend, self).__init__(f's3://{bucket}')
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+
+    def _filesystem(self, anon: bool = False) -> s3fs.S3FileSystem:
+        return get_s3_filesystem(anon, self.endpoint_url)
+
+    def _strip_bucket(self, path: str) -> str:
+        return path[len(self.bucket):].lstrip('/')
+
+    def ls(self, prefix: str = '', files_only: bool = False) -> typing.List[str]:
+        fs = self._filesystem(anon=True)
+        try:
+            entries = fs.ls(os.path.join(self.bucket, prefix), detail=True)
+        except FileNotFoundError:
+            return []
+        return [self._strip_bucket(entry['name']) for entry in entries if not files_only or entry['type'] == 'file']
+
+    def exists(self, key: str) -> bool:
+        return self._filesystem(anon=True).exists(os.path.join(self.bucket, key))
+
+    def size(self, key: str) -> int:
+        return self._filesystem(anon=True).size(os.path.join(self.bucket, key))
+
+    def open(self, key: str, mode: str = 'rb') -> typing.IO:
+        return self._filesystem().open(os.path.join(self.bucket, key), mode)
+
+    def arrow_filesystem(self) -> arrow_fs.FileSystem:
+        return arrow_fs.PyFileSystem(arrow_fs.FSSpecHandler(self._filesystem()))
+
+    def arrow_path(self, key: str) -> str:
+        return os.path.join(self.bucket, key)
+
+    def read_bytes(self, key: str) -> bytes:
+        client = get_s3_client(self.endpoint_url)
+        try:
+            obj = client.get_object(Bucket=self.bucket, Key=key)
+        except client.exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+        return obj['Body'].read()
+
+    def write_bytes(self, key: str, data: bytes):
+        get_s3_client(self.endpoint_url).put_object(
+            Bucket=self.bucket, Key=key, Body=data)
+
+
+class LocalBackend(StorageBackend):
+    def __init__(self, root: str = DEFAULT_LOCAL_ROOT):
+        """Root is a directory on local disk, i.e. fast NVMe scratch space."""
+        super(LocalBackend, self).__init__(os.path.abspath(root))
+
+    def ls(self, prefix: str = '', files_only: bool = False) -> typing.List[str]:
+        path = self.url(prefix)
+        if os.path.isfile(path):
+            return [prefix]
+        if not os.path.isdir(path):
+            return []
+        return [os.path.join(prefix, name) for name in sorted(os.listdir(path))
+                if not files_only or os.path.isfile(os.path.join(path, name))]
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.url(key))
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self.url(key))
+
+    def open(self, key: str, mode: str = 'rb') -> typing.IO:
+        path = self.url(key)
+        if 'w' in mode:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, mode)
+
+    def arrow_filesystem(self) -> arrow_fs.FileSystem:
+        # Memory map files so datasets are paged in lazily and shared through the page cache
+        return arrow_fs.LocalFileSystem(use_mmap=True)
+
+    def arrow_path(self, key: str) -> str:
+        return self.url(key)
+
+    def local_path(self, key: str, cache_dir: str) -> str:
+        """Files are already on local disk, so nothing is copied."""
+        return self.url(key)
+
+    def write_bytes(self, key: str, data: bytes):
+        """Writes to a temporary file and renames it, so readers never see a partially written file."""
+        path = self.url(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def create_backend(name: str = None) -> StorageBackend:
+    """
+    This function creates a storage backend from its name, reading the rest of its configuration from the environment.
+
+    Args:
+        name (str, optional): "s3" or "local". Defaults to the STORAGE_BACKEND environment variable, then "s3".
+
+    Returns:
+        StorageBackend: backend corresponding to the name
+    """
+    name = (name or os.environ.get('STORAGE_BACKEND', 's3')).lower()
+    if name == 's3':
+        return S3Backend(os.environ.get('S3_BUCKET', BUCKET_NAME),
+                         os.environ.get('S3_ENDPOINT_URL'))
+    if name == 'local':
+        return LocalBackend(os.environ.get('LOCAL_STORAGE_ROOT', DEFAULT_LOCAL_ROOT))
+    raise ValueError(f'Unknown storage backend {name}. Use "s3" or "local".')
+
+
+def get_backend() -> StorageBackend:
+    """Returns the process-wide storage backend, creating it from the environment on first use."""
+    global _backend
+    if _backend is None:
+        _backend = create_backend()
+    return _backend
+
+
+def set_backend(backend: StorageBackend = None):
+    """Overrides the process-wide storage backend. Passing None resets it to the environment configuration."""
+    global _backend
+    _backend = backend
@@ -0,0 +1,220 @@
+"""
+telemetry.py
+
+This file contains fixed-memory metrics for the inference API, rendered in the Prometheus text format:
+- Histogram: HDR-style log-linear histogram of integer values (i.e. microseconds or batch sizes). Each power of two is split
+  into 2 ** (SIGNIFICANT_BITS - 1) linear sub-buckets, so percentiles are accurate to a few percent at any scale.
+- Counter: monotonically increasing count
+- Info: constant 1 with labels computed when rendered (i.e. the model version)
+
+Histogram and counter values live in anonymous shared memory, with one row per process slot. Metrics created before a server
+forks its workers (i.e. when gunicorn preloads the app) are shared by all workers, so any worker reports the totals for the
+whole server. Each worker records only into its own slot (see set_process_slot), under a lock private to the process, so
+workers never wait on each other and a killed worker can't leave a lock held.
+"""
+from contextlib import contextmanager
+
+import mmap
+import numpy as np
+import os
+import threading
+import time
+import typing
+
+SIGNIFICANT_BITS = 5
+# Largest value recorded exactly; larger values go in the last bucket (2 ** 36 microseconds is about 19 hours)
+MAX_VALUE = 2 ** 36
+
+# Processes that can record at once with their own rows. Rows no process writes to take no memory.
+MAX_PROCESSES = int(os.environ.get('TELEMETRY_MAX_PROCESSES', 64))
+
+# This process's row in every metric
+_slot = 0
+# Serializes this process's threads. Other processes write other rows.
+_lock = threading.Lock()
+
+
+def _reset_lock():
+    # A thread of the parent may have held the lock when it forked
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_lock)
+
+
+def set_process_slot(slot: int):
+    """
+    Makes this process record into row slot of every metric. Processes that record at the same time need different slots
+    (i.e. inference/server.py gives one to each worker when it forks). A process that replaces another may reuse its slot.
+    """
+    global _slot
+    assert 0 <= slot < MAX_PROCESSES, f'Slot must be between 0 and {MAX_PROCESSES - 1}.'
+    _slot = slot
+
+
+def _shared_array(shape: tuple) -> np.ndarray:
+    """Returns an int64 array of zeros with a row per process slot in anonymous shared memory, which forked processes write to in place."""
+    shape = (MAX_PROCESSES,) + shape
+    size = int(np.prod(shape)) * 8
+    return np.frombuffer(mmap.mmap(-1, size), dtype=np.int64).reshape(shape)
+
+
+def _format_value(value: float) -> str:
+    # Drops the noise scaling adds, i.e. 1.4999999999999999e-05 for 15 microseconds
+    return '%.15g' % value
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+class Histogram(object):
+    """Log-linear histogram with one row of buckets per label value."""
+
+    def __init__(self, name: str, documentation: str, label_name: str = None, label_values: typing.List[str] = [None], scale: float = 1.0):
+        """
+        Constructor.
+
+        Args:
+            name (str): metric name, i.e. "high_tip_stage_seconds"
+            documentation (str): help text
+            label_name (str, optional): name of the label that distinguishes rows, i.e. "stage"
+            label_values (List[str], optional): every value the label takes
+            scale (float, optional): factor from recorded values to rendered values, i.e. 1e-6 to record microseconds and render seconds
+        """
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+        self.label_values = list(label_values)
+        self.scale = scale
+        self._sub_buckets = 2 ** SIGNIFICANT_BITS
+        self._half = self._sub_buckets // 2
+        self._upper_bounds = np.array([self._upper_bound(i) for i in range(
+            self._bucket_index(MAX_VALUE) + 1)], dtype=np.int64)
+        self._counts = _shared_array(
+            (len(self.label_values), len(self._upper_bounds)))
+        self._sums = _shared_array((len(self.label_values),))
+
+    def _bucket_index(self, value: int) -> int:
+        if value < self._sub_buckets:
+            return value
+        shift = value.bit_length() - SIGNIFICANT_BITS
+        return self._sub_buckets + (shift - 1) * self._half + (value >> shift) - self._half
+
+    def _upper_bound(self, index: int) -> int:
+        """Returns the largest value in a bucket."""
+        if index < self._sub_buckets:
+            return index
+        shift, offset = divmod(index - self._sub_buckets, self._half)
+        return ((self._half + offset + 1) << (shift + 1)) - 1
+
+    def record(self, value: int, label: str = None):
+        value = min(max(int(value), 0), MAX_VALUE)
+        row = self.label_values.index(label)
+        index = self._bucket_index(value)
+        with _lock:
+            self._counts[_slot, row, index] += 1
+            self._sums[_slot, row] += value
+
+    @contextmanager
+    def time(self, label: str = None):
+        """Records the microseconds spent in a with block."""
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.record((time.perf_counter_ns() - start) // 1000, label)
+
+    def _row_counts(self, row: int) -> np.ndarray:
+        """Returns the counts of a label summed over every process."""
+        return self._counts[:, row].sum(axis=0)
+
+    def count(self, label: str = None) -> int:
+        return int(self._row_counts(self.label_values.index(label)).sum())
+
+    def percentile(self, q: float, label: str = None) -> float:
+        """Returns the (scaled) value that q percent of recorded values are at or below, to within a bucket."""
+        counts = self._row_counts(self.label_values.index(label))
+        total = counts.sum()
+        if total == 0:
+            return 0.0
+        # The bucket holding the ceil(q% of total)th value, and at least the first value
+        rank = max(int(np.ceil(q / 100 * total)), 1)
+        index = int(np.searchsorted(np.cumsum(counts), rank))
+        return float(self._upper_bounds[index]) * self.scale
+
+    def render(self) -> typing.List[str]:
+        """
+        Returns Prometheus histogram lines. Buckets are rendered at powers of two, which keeps the exposition small and
+        the cumulative counts exact, since every sub-bucket falls within one power of two.
+        """
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} histogram']
+        bounds = [i for i, bound in enumerate(self._upper_bounds) if (
+            int(bound) + 1) & int(bound) == 0]
+        for row, label in enumerate(self.label_values):
+            labels = {self.label_name: label} if self.label_name else {}
+            cumulative = np.cumsum(self._row_counts(row))
+            for i in bounds:
+                bucket_labels = dict(
+                    labels, le=_format_value(self._upper_bounds[i] * self.scale))
+                lines.append(
+                    f'{self.name}_bucket{_format_labels(bucket_labels)} {cumulative[i]}')
+            lines.append(
+                f'{self.name}_bucket{_format_labels(dict(labels, le="+Inf"))} {cumulative[-1]}')
+            lines.append(
+                f'{self.name}_sum{_format_labels(labels)} {_format_value(self._sums[:, row].sum() * self.scale)}')
+            lines.append(
+                f'{self.name}_count{_format_labels(labels)} {cumulative[-1]}')
+        return lines
+
+
+class Counter(object):
+    """Counter with one value per combination of label values."""
+
+    def __init__(self, name: str, documentation: str, label_names: typing.List[str] = [], label_values: typing.List[tuple] = [()]):
+        """Constructor. label_values lists every combination of values for label_names that the counter is incremented with."""
+        self.name = name
+        self.documentation = documentation
+        self.label_names = list(label_names)
+        self.label_values = [tuple(values) for values in label_values]
+        self._values = _shared_array((len(self.label_values),))
+
+    def inc(self, *label_values, amount: int = 1):
+        row = self.label_values.index(tuple(label_values))
+        with _lock:
+            self._values[_slot, row] += amount
+
+    def value(self, *label_values) -> int:
+        return int(self._values[:, self.label_values.index(tuple(label_values))].sum())
+
+    def render(self) -> typing.List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} counter']
+        totals = self._values.sum(axis=0)
+        for row, values in enumerate(self.label_values):
+            labels = dict(zip(self.label_names, values))
+            lines.append(
+                f'{self.name}{_format_labels(labels)} {totals[row]}')
+        return lines
+
+
+class Info(object):
+    """Gauge that is always 1, with labels from a function called when rendered. Not shared between processes."""
+
+    def __init__(self, name: str, documentation: str, labels_fn: typing.Callable[[], dict]):
+        self.name = name
+        self.documentation = documentation
+        self.labels_fn = labels_fn
+
+    def render(self) -> typing.List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge',
+                f'{self.name}{_format_labels(self.labels_fn())} 1']
+
+
+def render(metrics: typing.List[typing.Any]) -> str:
+    """Returns the Prometheus text exposition of several metrics."""
+    return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
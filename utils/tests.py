@@ -4,10 +4,28 @@ test.py
 This file tests the various necessary util functions.
 """
 from .io import *
+from inference import app as inference_app, loadtest
+from . import artifact, benchmarks, feature_generators, models, parallel, search, serving, storage, telemetry
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.metrics import f1_score
+from unittest import mock
+import collections
 import contextlib
+import json
+import numpy as np
 import pandas as pd
+import signal
+import tempfile
+import threading
+import time
 import unittest
 
+RAW_CSV = """VendorID,tpep_pickup_datetime,tpep_dropoff_datetime,passenger_count,trip_distance,RatecodeID,store_and_fwd_flag,PULocationID,DOLocationID,payment_type,fare_amount,extra,mta_tax,tip_amount,tolls_amount,improvement_surcharge,total_amount,congestion_surcharge
+1,2020-01-01 00:28:15,2020-01-01 00:33:03,1,1.20,1,N,238,239,1,6,3,0.5,1.47,0,0.3,11.27,2.5
+1,2020-01-01 00:35:39,2020-01-01 00:43:04,1,1.20,1,N,239,238,1,7,3,0.5,1.5,0,0.3,12.3,2.5
+2,2020-01-31 23:47:41,2020-02-01 00:53:52,,.60,,,238,238,1,0,3,0.5,1,0,0.3,4.8,2.5
+"""
+
 
 @contextlib.contextmanager
 def set_env(environ):
@@ -92,5 +110,837 @@ class IOTests(unittest.TestCase):
         self.assertEqual(filename_1, filename_2)
 
 
+class LocalStorageTests(unittest.TestCase):
+
+    def setUp(self):
+        self.toy_df = pd.DataFrame({'col1': [1, 2, 3], 'col2': [2, 4, 6]})
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.backend = storage.LocalBackend(self.tmpdir.name)
+        os.makedirs(self.backend.url('dev/test'))
+        storage.set_backend(self.backend)
+        self.csv_path = os.path.join(self.tmpdir.name, 'raw.csv')
+        with open(self.csv_path, 'w') as f:
+            f.write(RAW_CSV)
+        self.patches = [
+            mock.patch('utils.io.get_raw_data_filename',
+                       return_value=self.csv_path),
+            mock.patch('utils.io.RAW_CACHE_DIR',
+                       os.path.join(self.tmpdir.name, 'cache')),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        storage.set_backend(None)
+        self.tmpdir.cleanup()
+
+    def test_local_path(self):
+        self.backend.write_bytes('dev/test/data.bin', b'data')
+        self.assertEqual(self.backend.local_path(
+            'dev/test/data.bin', 'unused'), self.backend.url('dev/test/data.bin'))
+        # Remote backends download the key into the cache directory
+        cache_dir = os.path.join(self.tmpdir.name, 'outputs')
+        path = storage.StorageBackend.local_path(
+            self.backend, 'dev/test/data.bin', cache_dir)
+        self.assertEqual(path, os.path.join(cache_dir, 'dev/test/data.bin'))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_create_backend_from_env(self):
+        with set_env({'STORAGE_BACKEND': 'local', 'LOCAL_STORAGE_ROOT': self.tmpdir.name}):
+            self.assertIsInstance(storage.create_backend(), storage.LocalBackend)
+        with self.assertRaises(ValueError):
+            storage.create_backend('gcs')
+
+    def test_write_file_scratch(self):
+        filename = write_file(self.toy_df, 'test.pq')
+        self.assertEqual(filename, os.path.join(
+            self.tmpdir.name, 'scratch/test.pq'))
+
+    def test_save_and_load_output_df(self):
+        filename = save_output_df(self.toy_df, 'test', version='20210101-000000')
+        self.assertEqual(get_output_path('test'), filename)
+        pd.testing.assert_frame_equal(load_output_df('test'), self.toy_df)
+
+    def test_load_latest_output_pkl(self):
+        save_output_pkl({'version': 1}, 'test', version='20210101-000000')
+        save_output_pkl({'version': 2}, 'test', version='20210102-000000')
+        self.assertEqual(load_output_pkl('test'), {'version': 2})
+
+    def test_save_output_no_overwrite(self):
+        save_output_df(self.toy_df, 'test', version='test_no_overwrite')
+        with self.assertRaises(OSError):
+            save_output_df(self.toy_df, 'test', version='test_no_overwrite')
+
+    def test_save_output_missing_component(self):
+        with self.assertRaises(AssertionError):
+            save_output_df(self.toy_df, 'missing')
+
+    def test_read_file_chunks(self):
+        chunks = list(read_file('01', '2020', chunksize=2))
+        df = read_file('01', '2020')
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(df.passenger_count.dtype, 'Int8')
+        self.assertEqual(df.fare_amount.dtype, 'float32')
+        self.assertEqual(df.PULocationID.dtype, 'category')
+        self.assertTrue(df.RatecodeID.isna().iloc[2])
+
+    def test_read_file_from_cache(self):
+        csv_df = read_file('01', '2020')
+        path = cache_raw_file('01', '2020')
+        self.assertTrue(path.endswith('year=2020/month=01/part-0.parquet'))
+        os.remove(self.csv_path)
+        pd.testing.assert_frame_equal(read_file('01', '2020'), csv_df)
+        chunks = list(read_file('01', '2020', chunksize=2))
+        pd.testing.assert_frame_equal(
+            pd.concat(chunks, ignore_index=True), csv_df)
+
+    def test_save_output_chunks(self):
+        chunks = [self.toy_df.iloc[:2], self.toy_df.iloc[2:]]
+        save_output_chunks(iter(chunks), 'test', version='20210101-000000')
+        pd.testing.assert_frame_equal(load_output_df('test'), self.toy_df)
+
+    def test_manifest_tracks_latest_version(self):
+        save_output_df(self.toy_df, 'test', version='20210102-000000')
+        save_output_df(self.toy_df, 'test', version='20210101-000000')
+        save_output_df(self.toy_df, 'test', version='not_a_timestamp')
+        manifest = load_manifest('test')
+        self.assertEqual(manifest['latest'], 'dev/test/20210102-000000.pq')
+        self.assertEqual(len(manifest['files']), 3)
+
+    def test_save_output_df_with_schema(self):
+        save_output_df(self.toy_df, 'test', version='20210101-000000',
+                       schema={'col1': 'int8', 'missing': 'int8'})
+        self.assertEqual(load_output_df('test').dtypes.tolist(), ['int8', 'int64'])
+
+    def test_load_output_df_pushdown(self):
+        df = pd.DataFrame({'col1': range(300_000), 'col2': range(300_000)})
+        save_output_df(df, 'test', version='20210101-000000')
+        loaded = load_output_df('test', columns=['col1'], filters=[
+                                ('col2', '>=', 299_990)])
+        pd.testing.assert_frame_equal(loaded, df[['col1']].iloc[-10:].reset_index(drop=True))
+        sampled = load_output_df('test', sample_frac=0.3)
+        self.assertEqual(len(sampled), ROW_GROUP_SIZE)
+        sampled = load_output_df('test', columns=['col1'], filters=[
+                                 ('col2', '<', 0)], sample_frac=0.5)
+        self.assertEqual(sampled.columns.tolist(), ['col1'])
+        self.assertEqual(len(sampled), 0)
+
+    def test_output_dataset(self):
+        os.makedirs(self.backend.url('dev/train'))
+        save_output_df(self.toy_df.astype({'col1': 'Int8'}), 'test', version='20210101-000000')
+        save_output_df(self.toy_df.astype({'col1': 'Int8'}), 'test', version='20210102-000000')
+        save_output_dataset(['test', 'test'], 'train', version='20210103-000000')
+        # Datasets pin the versions that were latest when they were created
+        save_output_df(self.toy_df.iloc[:1], 'test', version='20210104-000000')
+
+        expected = pd.concat([self.toy_df] * 2, ignore_index=True).astype({'col1': 'Int8'})
+        pd.testing.assert_frame_equal(load_output_df('train'), expected)
+        pd.testing.assert_frame_equal(load_output_df('train', columns=['col2'], filters=[('col2', '>', 2)]),
+                                      expected.loc[expected.col2 > 2, ['col2']].reset_index(drop=True))
+        self.assertEqual(len(load_output_df('train', sample_frac=0.5)), 3)
+        self.assertEqual(load_output_dataset('train').count_rows(), 6)
+
+    def test_output_metadata(self):
+        save_output_df(self.toy_df, 'test', version='20210101-000000',
+                       metadata={'fingerprint': 'abc'})
+        save_output_df(self.toy_df, 'test', version='20210102-000000')
+        self.assertEqual(get_output_metadata('test'), {})
+        self.assertEqual(get_output_metadata(
+            'test', version='20210101-000000'), {'fingerprint': 'abc'})
+
+    def test_get_output_path_does_not_list(self):
+        save_output_df(self.toy_df, 'test', version='20210101-000000')
+        self.backend.ls = None
+        self.assertTrue(get_output_path('test').endswith('20210101-000000.pq'))
+        self.assertTrue(get_output_path(
+            'test', version='20210101-000000').endswith('20210101-000000.pq'))
+
+    def test_get_output_path_without_manifest(self):
+        self.toy_df.to_parquet(self.backend.url('dev/test/20210101-000000.pq'))
+        self.assertTrue(get_output_path('test').endswith('20210101-000000.pq'))
+
+    def test_version_saved_before_manifest(self):
+        self.toy_df.to_parquet(self.backend.url('dev/test/20210101-000000.pq'))
+        save_output_df(self.toy_df.iloc[:1], 'test', version='20210102-000000')
+        pd.testing.assert_frame_equal(load_output_df('test', version='20210101-000000'), self.toy_df)
+        self.assertEqual(len(load_output_df('test')), 1)
+
+    def test_version_is_subdirectory(self):
+        # i.e. load_output_df('clean', version='2020_01') loads the latest clean/2020_01
+        os.makedirs(self.backend.url('dev/test/2020_01'))
+        save_output_df(self.toy_df, 'test/2020_01', version='20210101-000000')
+        save_output_df(self.toy_df.iloc[:1], 'test/2020_01', version='20210102-000000')
+        # With and without a manifest for the parent component
+        self.assertEqual(len(load_output_df('test', version='2020_01')), 1)
+        save_output_df(self.toy_df, 'test', version='20210103-000000')
+        self.assertEqual(len(load_output_df('test', version='2020_01')), 1)
+        # Subdirectories written before manifests existed are listed
+        os.makedirs(self.backend.url('dev/test/2020_02'))
+        self.toy_df.iloc[:2].to_parquet(self.backend.url('dev/test/2020_02/20210101-000000.pq'))
+        self.assertEqual(len(load_output_df('test', version='2020_02')), 2)
+
+
+class ClientRegistryTests(unittest.TestCase):
+
+    def tearDown(self):
+        storage.reset_clients()
+
+    def test_clients_are_reused(self):
+        self.assertIs(storage.get_s3_client(), storage.get_s3_client())
+        self.assertIs(storage.get_s3_filesystem(anon=True),
+                      storage.get_s3_filesystem(anon=True))
+        self.assertIsNot(storage.get_s3_filesystem(anon=True),
+                         storage.get_s3_filesystem(anon=False))
+
+    def test_reset_clients(self):
+        client = storage.get_s3_client()
+        storage.reset_clients()
+        self.assertIsNot(client, storage.get_s3_client())
+
+
+class CleaningTests(unittest.TestCase):
+
+    def setUp(self):
+        self.df = benchmarks.make_synthetic_trips(10_000)
+
+    def test_matches_string_comparison(self):
+        bounds = [(None, None), ('2020-01-02', None), (None, '2020-01-31'),
+                  ('2020-01-02', '2020-01-31'), ('2020-01-01', '2020-01-15 12:00:00')]
+        for start_date, end_date in bounds:
+            expected = benchmarks._remove_zero_fare_and_oob_rows_str(
+                self.df, start_date, end_date)
+            pd.testing.assert_frame_equal(remove_zero_fare_and_oob_rows(
+                self.df, start_date, end_date), expected)
+
+    def test_chunks_match_whole_month(self):
+        expected = remove_zero_fare_and_oob_rows(
+            self.df, '2020-01-01', '2020-01-31')
+        chunks = [remove_zero_fare_and_oob_rows(self.df.iloc[i:i + 3000], '2020-01-01', '2020-01-31')
+                  for i in range(0, len(self.df), 3000)]
+        pd.testing.assert_frame_equal(
+            pd.concat(chunks, ignore_index=True), expected)
+
+
+class FeatureGeneratorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.df = benchmarks.make_synthetic_trips(1000)
+        self.generators = [feature_generators.Pickup(), feature_generators.Trip(),
+                           feature_generators.Categorical(), feature_generators.HighTip()]
+
+    def test_pickup_matches_datetime_accessors(self):
+        pickup = self.df.tpep_pickup_datetime
+        features = feature_generators.Pickup().compute(self.df)
+        self.assertTrue((features.pickup_weekday == pickup.dt.weekday).all())
+        self.assertTrue((features.pickup_hour == pickup.dt.hour).all())
+        self.assertTrue((features.pickup_minute == pickup.dt.minute).all())
+        trip_time = feature_generators.Trip().compute(self.df).trip_time
+        self.assertTrue((trip_time == (self.df.tpep_dropoff_datetime - pickup).dt.seconds).all())
+
+    def test_compute_uses_schema_dtypes(self):
+        for generator in self.generators:
+            dtypes = generator.compute(self.df).dtypes
+            for col, dtype in generator.schema().items():
+                self.assertEqual(dtypes[col], pd.api.types.pandas_dtype(dtype))
+
+    def test_plan_matches_generators(self):
+        plan = feature_generators.FeaturePlan(
+            self.generators, passthrough_columns=['tpep_pickup_datetime'])
+        expected = pd.concat([generator.compute(self.df) for generator in self.generators] +
+                             [self.df[['tpep_pickup_datetime']]], axis=1)
+        pd.testing.assert_frame_equal(
+            plan.compute(self.df), expected.astype(plan.schema()))
+
+    def test_plan_fingerprint(self):
+        plan = feature_generators.FeaturePlan(self.generators)
+        self.assertEqual(plan.fingerprint('clean/a.pq'),
+                         feature_generators.FeaturePlan(self.generators).fingerprint('clean/a.pq'))
+        self.assertNotEqual(plan.fingerprint('clean/a.pq'),
+                            plan.fingerprint('clean/b.pq'))
+        self.assertNotEqual(plan.fingerprint('clean/a.pq'),
+                            feature_generators.FeaturePlan(self.generators[:1]).fingerprint('clean/a.pq'))
+
+    def test_compute_record_matches_compute(self):
+        plan = feature_generators.FeaturePlan(self.generators)
+        df = self.df.iloc[:200].copy()
+        df.loc[3, 'passenger_count'] = pd.NA
+        df.loc[4, 'tpep_pickup_datetime'] = pd.NaT
+        df.loc[5, 'tpep_dropoff_datetime'] = pd.NaT
+        expected = plan.compute(df)
+        expected = expected.astype(object).where(expected.notna(), None)
+        for i, record in enumerate(df.astype(object).where(df.notna(), None).to_dict('records')):
+            if record['tpep_pickup_datetime'] is not None:
+                record['tpep_pickup_datetime'] = record['tpep_pickup_datetime'].isoformat()
+            if record['tpep_dropoff_datetime'] is not None:
+                record['tpep_dropoff_datetime'] = str(record['tpep_dropoff_datetime'])
+            self.assertEqual(plan.compute_record(record), expected.iloc[i].to_dict())
+
+    def test_missing_timestamps(self):
+        df = self.df.iloc[:10].copy()
+        df.loc[0, 'tpep_pickup_datetime'] = pd.NaT
+        df.loc[1, 'tpep_dropoff_datetime'] = pd.NaT
+        plan = feature_generators.FeaturePlan(self.generators)
+        features = plan.compute(df)
+        expected = pd.concat([generator.compute(df) for generator in self.generators], axis=1)
+        pd.testing.assert_frame_equal(features, expected.astype(plan.schema()))
+        self.assertTrue(features.loc[0, ['pickup_weekday', 'pickup_hour', 'pickup_minute', 'trip_time']].isna().all())
+        self.assertFalse(features.loc[0, 'work_hours'])
+        self.assertTrue(pd.isna(features.loc[1, 'trip_time']))
+        self.assertFalse(features.loc[1, ['pickup_weekday', 'pickup_hour', 'pickup_minute']].isna().any())
+        self.assertFalse(features.loc[2:].isna().any().any())
+
+    def test_compute_record_rejects_bad_values(self):
+        with self.assertRaises(ValueError):
+            feature_generators.Pickup().compute_record(
+                {'tpep_pickup_datetime': 'yesterday'})
+        with self.assertRaises(ValueError):
+            feature_generators.Categorical().compute_record(
+                {'PULocationID': 1.5, 'DOLocationID': 1, 'RatecodeID': 1})
+
+    def test_plan_rejects_duplicate_features(self):
+        with self.assertRaises(AssertionError):
+            feature_generators.FeaturePlan(
+                [feature_generators.Pickup(), feature_generators.Pickup()])
+
+
+class ModelTests(unittest.TestCase):
+
+    def setUp(self):
+        plan = feature_generators.FeaturePlan([feature_generators.Pickup(), feature_generators.Trip(),
+                                               feature_generators.Categorical(), feature_generators.HighTip()])
+        self.df = plan.compute(benchmarks.make_synthetic_trips(3000))
+        self.label_column = 'high_tip_indicator'
+        self.feature_columns = [
+            col for col in plan.schema() if col != self.label_column]
+        self.chunks = [self.df.iloc[i:i + 1000] for i in range(0, 3000, 1000)]
+
+    def test_preprocess(self):
+        df = self.df.copy()
+        df.loc[0, 'trip_distance'] = float('nan')
+        df.loc[1, 'RatecodeID'] = pd.NA
+        mw = models.RandomForestModelWrapper(
+            feature_columns=self.feature_columns)
+        X = mw.preprocess(df)
+        self.assertEqual(X.dtype, 'float32')
+        self.assertTrue(X.flags['C_CONTIGUOUS'])
+        np.testing.assert_array_equal(
+            X, df[self.feature_columns].astype('float32').fillna(models.IMPUTATION_VALUE).values)
+        # The buffer is reused by later calls on the same thread
+        self.assertTrue(np.shares_memory(X, mw.preprocess(df.iloc[:10])))
+        # Object columns, i.e. from dicts with None
+        df = pd.DataFrame({'a': [1.0, None], 'b': [2, 3]}, dtype=object)
+        mw = models.RandomForestModelWrapper(feature_columns=['a', 'b'])
+        np.testing.assert_array_equal(
+            mw.preprocess(df), [[1, 2], [models.IMPUTATION_VALUE, 3]])
+
+    def test_train_streaming(self):
+        mw = models.RandomForestModelWrapper(
+            feature_columns=self.feature_columns, model_params={'max_depth': 5})
+        mw.train_streaming(iter(self.chunks), self.label_column, trees_per_chunk=4)
+        self.assertEqual(len(mw.model.estimators_), 12)
+        self.assertEqual(mw.predict(self.df).shape, (3000,))
+
+    def test_score_streaming(self):
+        mw = models.RandomForestModelWrapper(
+            feature_columns=self.feature_columns, model_params={'n_estimators': 5, 'max_depth': 5})
+        mw.train(self.df, self.label_column)
+        self.assertAlmostEqual(mw.score_streaming(iter(self.chunks), self.label_column),
+                               mw.score(self.df, self.label_column))
+
+    def test_compiled_forest_matches_sklearn(self):
+        mw = models.RandomForestModelWrapper(
+            feature_columns=self.feature_columns, model_params={'n_estimators': 10, 'n_jobs': 1})
+        mw.train(self.df, self.label_column)
+        expected = mw.predict(self.df).copy()
+        mw.compile()
+        X = mw.preprocess(self.df)
+        np.testing.assert_array_equal(mw.compiled_model.predict_proba(X), expected)
+        np.testing.assert_array_equal(mw.predict(self.df.iloc[[5]]), expected[[5]])
+        # Retraining drops the compiled forest
+        mw.train(self.df.iloc[:1000], self.label_column)
+        self.assertIsNone(mw.compiled_model)
+
+    def test_artifact_round_trip(self):
+        mw = models.RandomForestModelWrapper(
+            feature_columns=self.feature_columns, model_params={'n_estimators': 5, 'n_jobs': 1})
+        mw.train(self.df, self.label_column)
+        mw.add_data_path('train_df', 'train.pq')
+        mw.add_metric('train_f1', np.float64(0.5))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            backend = storage.LocalBackend(tmpdir)
+            os.makedirs(backend.url('dev/models'))
+            storage.set_backend(backend)
+            try:
+                path = mw.save_artifact('models', version='20210101-000000')
+                loaded = models.RandomForestModelWrapper.load_artifact(
+                    'models')
+            finally:
+                storage.set_backend(None)
+        self.assertTrue(path.endswith('20210101-000000.model'))
+        self.assertIsNone(loaded.model)
+        self.assertEqual(loaded.feature_columns, self.feature_columns)
+        self.assertEqual(loaded.get_metrics(), {'train_f1': 0.5})
+        self.assertFalse(loaded.compiled_model.threshold.flags['WRITEABLE'])
+        np.testing.assert_array_equal(
+            loaded.predict(self.df), mw.model.predict_proba(mw.preprocess(self.df))[:, 1])
+
+    def test_artifact_rejects_other_files(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(pickle.dumps({'a': 1}) * 10)
+            f.flush()
+            with self.assertRaises(ValueError):
+                artifact.load(f.name)
+
+    def test_records_to_matrix(self):
+        mw = models.RandomForestModelWrapper(
+            feature_columns=self.feature_columns, model_params={'n_estimators': 5, 'n_jobs': 1})
+        df = self.df.iloc[:100].copy()
+        df.loc[0, 'trip_distance'] = float('nan')
+        df.loc[1, 'RatecodeID'] = pd.NA
+        records = df[self.feature_columns].astype(object).where(
+            df[self.feature_columns].notna(), None).to_dict('records')
+        del records[2]['trip_speed']
+        df.loc[2, 'trip_speed'] = float('nan')
+        np.testing.assert_array_equal(
+            mw.records_to_matrix(records), mw.preprocess(df).copy())
+
+        mw.train(self.df, self.label_column)
+        mw.compile()
+        np.testing.assert_array_equal(
+            mw.predict_records(records[:1]), mw.predict(df.iloc[:1]))
+        with self.assertRaisesRegex(ValueError, 'trip_distance'):
+            mw.predict_records([dict(records[0], trip_distance='fast')])
+
+    def test_wrappers_do_not_share_metrics(self):
+        models.RandomForestModelWrapper().add_metric('f1', 1.0)
+        self.assertEqual(models.RandomForestModelWrapper().get_metrics(), {})
+
+    def test_grid_candidates(self):
+        candidates = search.grid_candidates(
+            {'max_depth': [5, 10], 'n_estimators': [10, 20, 30]})
+        self.assertEqual(len(candidates), 6)
+        self.assertIn({'max_depth': 10, 'n_estimators': 20}, candidates)
+
+    def test_search(self):
+        mw = models.RandomForestModelWrapper(
+            feature_columns=self.feature_columns, model_params={'n_estimators': 5})
+        candidates = search.grid_candidates({'max_depth': [2, 4, 6, 8]})
+        results = search.search(mw, self.df, self.label_column, candidates,
+                                halving_factor=2, max_workers=2)
+        # 4 candidates, then 2, then 1 on all rows
+        self.assertEqual([result['n_samples'] for result in results], [3000, 1500, 1500, 750, 750, 750, 750])
+        self.assertEqual(mw.model_params['max_depth'], results[0]['params']['max_depth'])
+        self.assertEqual(mw.model_params['n_jobs'], models.ALL_PROCESSORS)
+        self.assertEqual(mw.get_metrics()['cv_f1'], results[0]['f1'])
+
+    def test_search_trial_trains_without_held_out_rows(self):
+        mw = models.RandomForestModelWrapper(feature_columns=self.feature_columns)
+        params = {'n_estimators': 5, 'min_samples_leaf': 20, 'random_state': 0}
+        X, y = mw.preprocess(self.df).copy(), self.df[self.label_column].to_numpy()
+        rows = np.random.RandomState(0).permutation(len(X))[:1500]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            X_path, y_path = search._write_shared_matrix(X, y, rows, tmp_dir)
+            score = search._run_trial(params, X_path, y_path, 3)
+        X, y = X[rows], y[rows]
+
+        expected = []
+        for start, end in [(0, 500), (500, 1000), (1000, 1500)]:
+            # The rows after the fold, then the rows before it
+            train = np.r_[end:1500, 0:start]
+            model = RandomForestClassifier(**params).fit(X[train], y[train])
+            expected.append(f1_score(y[start:end], model.predict(X[start:end])))
+        self.assertEqual(score, np.mean(expected))
+
+
+def _month_number(month: str, year: str) -> int:
+    assert month != '13', 'Invalid month.'
+    if month == '01' and year == '1999':
+        # Like the kernel killing a worker that runs out of memory
+        os.kill(os.getpid(), signal.SIGKILL)
+    if month == '02' and year == '1999':
+        time.sleep(0.5)
+    return int(month)
+
+
+class ParallelTests(unittest.TestCase):
+
+    def test_run_months(self):
+        month_years = [(f'{month:02d}', '2020') for month in range(1, 7)]
+        for max_workers in [1, 3]:
+            results = parallel.run_months(
+                _month_number, month_years, max_workers=max_workers)
+            self.assertEqual(results, {(month, year): int(month)
+                                       for month, year in month_years})
+
+    def test_run_months_over_memory_budget(self):
+        month_years = [('01', '2020'), ('02', '2020'), ('03', '2020')]
+        results = parallel.run_months(_month_number, month_years, estimate_memory=lambda month, year: 10,
+                                      max_workers=3, memory_budget=5)
+        self.assertEqual(len(results), 3)
+
+    def test_failed_month_does_not_stop_others(self):
+        month_years = [('12', '2020'), ('13', '2020'), ('11', '2020')]
+        with mock.patch('builtins.print') as mock_print:
+            with self.assertRaises(RuntimeError):
+                parallel.run_months(
+                    _month_number, month_years, max_workers=2)
+        printed = ' '.join(str(call) for call in mock_print.call_args_list)
+        self.assertIn('2020_12: 12', printed)
+        self.assertIn('2020_11: 11', printed)
+        self.assertIn('2020_13 failed', printed)
+
+    def test_killed_worker_does_not_stop_others(self):
+        month_years = [(f'{month:02d}', '1999') for month in range(1, 7)]
+        with mock.patch('builtins.print') as mock_print:
+            with self.assertRaises(RuntimeError) as context:
+                parallel.run_months(_month_number, month_years, max_workers=2)
+        # Month 02 was in flight when month 01's worker died, so it may have failed with it
+        self.assertIn('1999_01', str(context.exception))
+        printed = ' '.join(str(call) for call in mock_print.call_args_list)
+        for month in ['03', '04', '05', '06']:
+            self.assertIn(f'1999_{month}: {int(month)}', printed)
+
+    def test_failed_estimate_does_not_stop_others(self):
+        def estimate_memory(month, year):
+            if month == '02':
+                raise ValueError('No output for clean/2020_02.')
+            return 1
+
+        month_years = [('01', '2020'), ('02', '2020'), ('03', '2020')]
+        with mock.patch('builtins.print') as mock_print:
+            with self.assertRaisesRegex(RuntimeError, '1 month'):
+                parallel.run_months(
+                    _month_number, month_years, estimate_memory=estimate_memory, max_workers=2)
+        printed = ' '.join(str(call) for call in mock_print.call_args_list)
+        self.assertIn('2020_02 failed', printed)
+        self.assertIn('No output for clean/2020_02.', printed)
+        self.assertIn('2020_01: 1', printed)
+        self.assertIn('2020_03: 3', printed)
+
+
+class ServingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.batch_sizes = []
+
+    def _double(self, records):
+        self.batch_sizes.append(len(records))
+        if any(record['x'] is None for record in records):
+            raise ValueError('x is missing.')
+        return [2 * record['x'] for record in records]
+
+    def test_micro_batcher_batches_concurrent_requests(self):
+        batcher = serving.MicroBatcher(
+            self._double, max_batch_size=8, max_wait=0.05)
+        futures = [batcher.submit({'x': i}) for i in range(20)]
+        self.assertEqual([future.result(5) for future in futures], [
+                         2 * i for i in range(20)])
+        self.assertLess(len(self.batch_sizes), 20)
+        self.assertLessEqual(max(self.batch_sizes), 8)
+
+    def test_micro_batcher_isolates_errors(self):
+        batcher = serving.MicroBatcher(
+            self._double, max_batch_size=8, max_wait=0.05)
+        results = {}
+
+        def request(x):
+            try:
+                results[x] = batcher.predict({'x': x}, timeout=5)
+            except ValueError:
+                results[x] = 'error'
+
+        threads = [threading.Thread(target=request, args=(x,))
+                   for x in [1, None, 3]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {1: 2, None: 'error', 3: 6})
+
+    def test_model_reloader(self):
+        versions = ['20210101-000000']
+        warmed_up = []
+
+        def load(version):
+            assert version != 'bad', 'Bad version.'
+            return {'version': version}
+
+        reloader = serving.ModelReloader(
+            load, lambda: versions[-1], warmed_up.append, poll_interval=0)
+        self.assertFalse(reloader.ready)
+        reloader.start()
+        self.assertTrue(reloader.ready)
+        self.assertEqual(reloader.current, ({'version': '20210101-000000'}, '20210101-000000'))
+        self.assertEqual(warmed_up, [{'version': '20210101-000000'}])
+
+        self.assertFalse(reloader.load())
+        versions.append('20210102-000000')
+        self.assertTrue(reloader.load())
+        self.assertEqual(reloader.current[1], '20210102-000000')
+        # A version that fails to load is never served
+        with self.assertRaises(AssertionError):
+            reloader.load('bad')
+        self.assertEqual(reloader.current[1], '20210102-000000')
+
+    def test_prediction_cache(self):
+        cache = serving.PredictionCache(max_size=2, ttl=60)
+        scored = []
+
+        def predict_fn(X):
+            scored.append(len(X))
+            return X.sum(axis=1)
+
+        X = np.array([[1, 2], [3, 4], [1, 2]], dtype=np.float32)
+        np.testing.assert_array_equal(cache.predict(X, 'v1', predict_fn), [3, 7, 3])
+        np.testing.assert_array_equal(cache.predict(X[:2], 'v1', predict_fn), [3, 7])
+        self.assertEqual(scored, [3])
+        self.assertEqual(cache.stats()['hits'], 2)
+        # Other versions and evicted or expired entries are scored again
+        cache.predict(X[:1], 'v2', predict_fn)
+        self.assertEqual(cache.get(('v1', X[0].tobytes())), None)
+        cache.ttl = -1
+        cache.predict(X[1:2], 'v2', predict_fn)
+        cache.predict(X[1:2], 'v2', predict_fn)
+        self.assertEqual(scored, [3, 1, 1, 1])
+        cache.clear()
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_reloader_calls_on_load(self):
+        loaded = []
+        reloader = serving.ModelReloader(
+            lambda version: version, lambda: '20210101-000000', poll_interval=0,
+            on_load=lambda model, version: loaded.append(version))
+        reloader.load()
+        reloader.load()
+        self.assertEqual(loaded, ['20210101-000000'])
+
+
+class AppTests(unittest.TestCase):
+
+    def setUp(self):
+        plan = feature_generators.FeaturePlan([feature_generators.Pickup(), feature_generators.Trip(),
+                                               feature_generators.Categorical(), feature_generators.HighTip()])
+        trips = benchmarks.make_synthetic_trips(500)
+        df = plan.compute(trips)
+        feature_columns = [col for col in df.columns if col != 'high_tip_indicator']
+        self.mw = models.RandomForestModelWrapper(
+            feature_columns=feature_columns, model_params={'n_estimators': 5, 'n_jobs': 1})
+        self.mw.train(df, 'high_tip_indicator')
+        self.records = df[feature_columns].iloc[:20].astype(object).where(
+            df.notna(), None).to_dict('records')
+        self.expected = self.mw.predict_records(self.records).tolist()
+        # The first raw trip, as a client would send it, whose features are the first record
+        self.trip = json.loads(trips[inference_app.online_plan.required_columns].iloc[:1].to_json(
+            orient='records', date_format='iso'))[0]
+        previous, inference_app.reloader.current = inference_app.reloader.current, (self.mw, '20210101-000000')
+        self.addCleanup(setattr, inference_app.reloader, 'current', previous)
+        self.client = inference_app.app.test_client()
+
+    def test_ready(self):
+        inference_app.reloader.current = (None, None)
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.get_json(), {'ready': False})
+        inference_app.reloader.current = (self.mw, '20210101-000000')
+        response = self.client.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json(), {'ready': True, 'version': '20210101-000000'})
+
+    def _metric_values(self) -> dict:
+        """Returns /metrics as {name with labels: value}. Metrics are kept across tests, so tests compare before and after."""
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+                for line in response.get_data(as_text=True).splitlines() if not line.startswith('#')}
+
+    def test_metrics(self):
+        before = self._metric_values()
+        for record in self.records[:2]:
+            self.client.post('/predict', json=record)
+        self.client.post('/predict', json={})
+        self.client.post('/predict_batch', json=self.records)
+        after = self._metric_values()
+        changes = {key: after[key] - before[key] for key in after if key in before and after[key] != before[key]}
+        self.assertEqual(changes['high_tip_requests_total{endpoint="predict",status="2xx"}'], 2)
+        self.assertEqual(changes['high_tip_requests_total{endpoint="predict",status="4xx"}'], 1)
+        self.assertEqual(changes['high_tip_requests_total{endpoint="predict_batch",status="2xx"}'], 1)
+        self.assertNotIn('high_tip_requests_total{endpoint="predict_batch",status="4xx"}', changes)
+        # The invalid request never reaches the model
+        self.assertEqual(changes['high_tip_batch_size_count{endpoint="predict"}'], 2)
+        self.assertEqual(changes['high_tip_batch_size_count{endpoint="predict_batch"}'], 1)
+        self.assertEqual(changes['high_tip_batch_size_sum{endpoint="predict_batch"}'], len(self.records))
+        self.assertEqual(after['high_tip_model_info{version="20210101-000000"}'], 1)
+
+    def test_predict_raw_trip(self):
+        response = self.client.post('/predict', json=self.trip)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['prediction'], self.expected[0])
+
+    def test_predict_rejects_missing_raw_columns(self):
+        trip = dict(self.trip)
+        del trip['DOLocationID']
+        response = self.client.post('/predict', json=trip)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Record 0 is missing columns ['DOLocationID']", response.get_json()['error'])
+
+    def test_predict_rejects_malformed_timestamps(self):
+        response = self.client.post('/predict', json=dict(self.trip, tpep_pickup_datetime='yesterday'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('tpep_pickup_datetime must be an ISO 8601 timestamp', response.get_json()['error'])
+
+    def test_predict_batch_json(self):
+        response = self.client.post('/predict_batch', json=self.records)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([pred['prediction'] for pred in response.get_json()], self.expected)
+
+    def test_predict_batch_jsonl(self):
+        body = '\n'.join(json.dumps(record) for record in self.records) + '\n'
+        response = self.client.post('/predict_batch', data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['prediction'] for line in lines], self.expected)
+
+    def test_predict_batch_rejects_malformed_jsonl(self):
+        body = json.dumps(self.records[0]) + '\n{"pickup_hour": \n'
+        response = self.client.post('/predict_batch', data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Line 2 is not valid JSON', response.get_json()['error'])
+
+    def test_predict_batch_rejects_missing_features(self):
+        records = [dict(record) for record in self.records[:2]]
+        del records[1]['trip_distance']
+        response = self.client.post('/predict_batch', json=records)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Record 1 is missing features ['trip_distance']", response.get_json()['error'])
+
+    def test_predict_batch_rejects_too_many_records(self):
+        with mock.patch.object(inference_app, 'MAX_BATCH_SIZE', 10), \
+                mock.patch.object(inference_app, '_to_feature_records') as to_feature_records:
+            response = self.client.post('/predict_batch', json=self.records)
+        self.assertEqual(response.status_code, 413)
+        # Rejected before any features are computed
+        to_feature_records.assert_not_called()
+
+    def test_predict_batch_rejects_large_bodies(self):
+        with mock.patch.dict(inference_app.app.config, {'MAX_CONTENT_LENGTH': 100}), \
+                mock.patch.object(inference_app, '_decode_records') as decode_records:
+            response = self.client.post('/predict_batch', json=self.records)
+        self.assertEqual(response.status_code, 413)
+        self.assertIn('at most', response.get_json()['error'])
+        # Rejected before the body is read or decoded
+        decode_records.assert_not_called()
+
+
+class LoadTestTests(unittest.TestCase):
+
+    def test_make_bodies(self):
+        records = [{'a': i} for i in range(5)]
+        bodies = loadtest.make_bodies(records, 'predict')
+        self.assertEqual(bodies[1], (b'{"a": 1}', 1))
+        self.assertEqual(len(bodies), 5)
+        bodies = loadtest.make_bodies(records, 'predict_batch', batch_size=2)
+        self.assertEqual([num_records for _, num_records in bodies], [2, 2, 1])
+        self.assertEqual(json.loads(bodies[2][0]), [{'a': 4}])
+        with self.assertRaises(AssertionError):
+            loadtest.make_bodies(records, 'score')
+
+    def test_run_closed_loop(self):
+        sent = collections.Counter()
+        lock = threading.Lock()
+
+        def post(url, data, headers, timeout):
+            with lock:
+                sent[data] += 1
+            time.sleep(0.001)
+            if data == b'down':
+                raise loadtest.requests.ConnectionError()
+            status_code = 200 if data == b'ok' else 500
+            return mock.Mock(ok=status_code == 200, status_code=status_code)
+
+        bodies = [(b'ok', 3), (b'fail', 3), (b'ok', 3), (b'down', 3)]
+        with mock.patch.object(loadtest.requests, 'Session') as session:
+            session.return_value.post.side_effect = post
+            report = loadtest.run('http://test/predict_batch', bodies, concurrency=2, rate=0, duration=0.2)
+
+        self.assertEqual(report['requests'], sum(sent.values()))
+        self.assertGreater(report['requests'], 4)
+        self.assertEqual(report['records'], 3 * sent[b'ok'])
+        self.assertEqual(report['errors'], {'500': sent[b'fail'], 'ConnectionError': sent[b'down']})
+        self.assertEqual(report['error_rate'], (sent[b'fail'] + sent[b'down']) / report['requests'])
+        self.assertAlmostEqual(report['requests_per_second'], report['requests'] / report['seconds'])
+        self.assertGreaterEqual(report['latency_ms']['p99'], 1)
+
+
+class TelemetryTests(unittest.TestCase):
+    def test_histogram_percentiles(self):
+        histogram = telemetry.Histogram('latency_seconds', 'Latency.', scale=1e-6)
+        values = np.random.RandomState(0).lognormal(7, 1, 10_000).astype(int)
+        for value in values:
+            histogram.record(value)
+        self.assertEqual(histogram.count(), len(values))
+        # Values are bucketed to within 1 / 2 ** (SIGNIFICANT_BITS - 1) of their size
+        for q in [50, 99]:
+            expected = np.percentile(values, q) * 1e-6
+            self.assertAlmostEqual(histogram.percentile(
+                q), expected, delta=expected / 2 ** (telemetry.SIGNIFICANT_BITS - 2))
+        # Small values are exact and large ones are clamped
+        histogram.record(3)
+        histogram.record(10 ** 15)
+        self.assertEqual(histogram.percentile(0), 3e-6)
+        self.assertGreaterEqual(histogram.percentile(100), telemetry.MAX_VALUE * 1e-6)
+        self.assertLess(histogram.percentile(100), 1.1 * telemetry.MAX_VALUE * 1e-6)
+
+    def test_metrics_are_shared_with_forked_processes(self):
+        histogram = telemetry.Histogram('batch_size', 'Batch size.')
+        counter = telemetry.Counter('requests_total', 'Requests.')
+        histogram.record(5)
+        pid = os.fork()
+        if pid == 0:
+            telemetry.set_process_slot(1)
+            histogram.record(5)
+            counter.inc()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(histogram.count(), 2)
+        self.assertIn('batch_size_sum 10', histogram.render())
+        self.assertEqual(counter.value(), 1)
+
+    def test_killed_process_does_not_block_others(self):
+        histogram = telemetry.Histogram('batch_size', 'Batch size.')
+        pid = os.fork()
+        if pid == 0:
+            # Like gunicorn killing a worker in the middle of recording
+            telemetry.set_process_slot(1)
+            telemetry._lock.acquire()
+            os.kill(os.getpid(), signal.SIGKILL)
+        os.waitpid(pid, 0)
+        histogram.record(5)
+        self.assertEqual(histogram.count(), 1)
+
+    def test_render(self):
+        histogram = telemetry.Histogram('stage_seconds', 'Latency by stage.', 'stage', ['decode', 'predict'], scale=1e-6)
+        histogram.record(100, 'predict')
+        counter = telemetry.Counter('requests_total', 'Requests.', ['status'], [('2xx',), ('4xx',)])
+        counter.inc('2xx')
+        counter.inc('2xx', amount=2)
+        info = telemetry.Info('model_info', 'Model version.', lambda: {'version': 'v1'})
+        lines = telemetry.render([histogram, counter, info]).splitlines()
+        self.assertIn('# TYPE stage_seconds histogram', lines)
+        self.assertIn('stage_seconds_bucket{stage="predict",le="6.3e-05"} 0', lines)
+        self.assertIn('stage_seconds_bucket{stage="predict",le="0.000127"} 1', lines)
+        self.assertIn('stage_seconds_bucket{stage="predict",le="+Inf"} 1', lines)
+        self.assertIn('stage_seconds_count{stage="decode"} 0', lines)
+        self.assertIn('stage_seconds_sum{stage="predict"} 0.0001', lines)
+        self.assertIn('requests_total{status="2xx"} 3', lines)
+        self.assertIn('requests_total{status="4xx"} 0', lines)
+        self.assertIn('model_info{version="v1"} 1', lines)
+        with self.assertRaises(ValueError):
+            counter.inc('5xx')
+
+
 if __name__ == '__main__':
     unittest.main()